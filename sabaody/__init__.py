@@ -4,6 +4,6 @@ __version__ = '0.1.0'
 
 
 #from .diffevo import differential_evolution
-from .pygmo_interf import Evaluator, Archipelago, Island, run_island
+from .pygmo_interf import Evaluator, BatchEvaluator, MemoizedEvaluator, Archipelago, Island, run_island
 #from .timecourse_model import TimecourseModel
 from .utils import getQualifiedName
\ No newline at end of file
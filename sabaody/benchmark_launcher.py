@@ -214,8 +214,12 @@ class BenchmarkLauncherBase:
         parser.add_argument('--selection-policy', required=True,
                             choices = [
                               'best-s-policy', 'best',
+                              'random-s-policy', 'random',
+                              'tournament-s-policy', 'tournament',
                             ],
                             help='The selection policy to use')
+        parser.add_argument('--tournament-size', type=int, default=2,
+                            help='The number of individuals in each tournament (tournament selection only).')
         parser.add_argument('--selection-rate', type=int,
                             help='The migration rate used in the selection policy (exclusive with --selection-fraction).')
         parser.add_argument('--selection-fraction', type=float,
@@ -223,6 +227,8 @@ class BenchmarkLauncherBase:
         parser.add_argument('--replacement-policy', required=True,
                             choices = [
                               'fair-r-policy', 'fair',
+                              'worst-r-policy', 'worst',
+                              'random-r-policy', 'random',
                             ],
                             help='The replacement policy to use.')
         parser.add_argument('--suite-run-id', required=True, type=int,
@@ -265,9 +271,9 @@ class BenchmarkLauncherBase:
         if args.selection_rate is not None and args.selection_fraction is not None:
             raise RuntimeError('Specify either --selection-rate or --selection-fraction, not both')
         if args.selection_rate is not None:
-            config.selection_policy = cls.select_selection_policy(args.selection_policy, migration_rate=args.selection_rate)
+            config.selection_policy = cls.select_selection_policy(args.selection_policy, migration_rate=args.selection_rate, tournament_size=args.tournament_size)
         elif args.selection_fraction is not None:
-            config.selection_policy = cls.select_selection_policy(args.selection_policy, pop_fraction=args.selection_fraction)
+            config.selection_policy = cls.select_selection_policy(args.selection_policy, pop_fraction=args.selection_fraction, tournament_size=args.tournament_size)
         else:
             raise RuntimeError('Specify either --selection-rate or --selection-fraction')
         config.replacement_policy = cls.select_replacement_policy(args.replacement_policy)
@@ -329,7 +335,10 @@ class BenchmarkLauncherBase:
     @classmethod
     def select_migration_policy(cls, policy_name):
         from sabaody.migration import MigrationPolicyEachToAll, MigrationPolicyUniform
-        if policy_name == 'each' or policy_name == 'each-to-all':
+        if policy_name == 'none' or policy_name == 'null':
+            # use the migrator's default
+            return None
+        elif policy_name == 'each' or policy_name == 'each-to-all':
             return MigrationPolicyEachToAll()
         elif policy_name == 'uniform':
             return MigrationPolicyUniform()
@@ -338,26 +347,31 @@ class BenchmarkLauncherBase:
 
 
     @classmethod
-    def select_selection_policy(cls, policy_name, migration_rate=None, pop_fraction=None):
-        from sabaody.migration import BestSPolicy
+    def select_selection_policy(cls, policy_name, migration_rate=None, pop_fraction=None, tournament_size=2):
+        from sabaody.migration import BestSPolicy, RandomSPolicy, TournamentSPolicy
+        if migration_rate is not None and pop_fraction is not None:
+            raise RuntimeError('Specify either migration rate or fraction, not both')
+        if migration_rate is None and pop_fraction is None:
+            raise RuntimeError('Neither migration rate nor fraction specified')
         if policy_name == 'best-s-policy' or policy_name == 'best':
-            if migration_rate is not None and pop_fraction is not None:
-                raise RuntimeError('Specify either migration rate or fraction, not both')
-            if migration_rate is not None:
-                return BestSPolicy(migration_rate=migration_rate)
-            elif pop_fraction is not None:
-                return BestSPolicy(pop_fraction=pop_fraction)
-            else:
-                raise RuntimeError('Neither migration rate nor fraction specified')
+            return BestSPolicy(migration_rate=migration_rate, pop_fraction=pop_fraction)
+        elif policy_name == 'random-s-policy' or policy_name == 'random':
+            return RandomSPolicy(migration_rate=migration_rate, pop_fraction=pop_fraction)
+        elif policy_name == 'tournament-s-policy' or policy_name == 'tournament':
+            return TournamentSPolicy(migration_rate=migration_rate, pop_fraction=pop_fraction, tournament_size=tournament_size)
         else:
             raise RuntimeError('Unknown selection policy')
 
 
     @classmethod
     def select_replacement_policy(cls, policy_name):
-        from sabaody.migration import FairRPolicy
+        from sabaody.migration import FairRPolicy, WorstRPolicy, RandomRPolicy
         if policy_name == 'fair-r-policy' or policy_name == 'fair':
             return FairRPolicy()
+        elif policy_name == 'worst-r-policy' or policy_name == 'worst':
+            return WorstRPolicy()
+        elif policy_name == 'random-r-policy' or policy_name == 'random':
+            return RandomRPolicy()
         else:
             raise RuntimeError('Unknown replacement policy')
 
@@ -366,7 +380,7 @@ class BenchmarkLauncherBase:
         if migrator_name == 'central' or migrator_name == 'central-migrator':
             from sabaody.migration_central import CentralMigrator
             # central migrator process must be running
-            return CentralMigrator(migration_policy, selection_policy, replacement_policy, 'http://luna:10100') # FIXME: hardcoded
+            return CentralMigrator('http://luna:10100', selection_policy, replacement_policy, migration_policy) # FIXME: hardcoded
         elif migrator_name == 'kafka' or migrator_name == 'kafka-migrator':
             from sabaody.kafka_migration_service import KafkaMigrator, KafkaBuilder
             # Kafka must be running
@@ -0,0 +1,155 @@
+# Sabaody
+# Copyright 2018 J Kyle Medley
+from __future__ import print_function, division, absolute_import
+
+from .pygmo_interf import Evaluator
+from .timecourse_model import TimecourseModel, SteadyStateCache
+from .model_cache import get_model
+from .utils import expect
+
+from numpy import array
+import attr
+import typing
+
+@attr.s
+class Experiment:
+    '''
+    A single experiment: the measured data plus the initial
+    conditions (e.g. a perturbation) it was recorded under.
+    See TimecourseModel for data_quantities and measurement_map.
+    '''
+    data_quantities = attr.ib()
+    measurement_map = attr.ib()
+    initial_conditions = attr.ib(default=attr.Factory(dict))
+    name = attr.ib(default='')
+
+# experiment set owned by the current worker process
+_experiment_worker_set = None
+
+def _init_experiment_worker(sbml, experiments, param_list, model_kwargs):
+    global _experiment_worker_set
+    _experiment_worker_set = ExperimentSet(sbml, experiments, param_list, **model_kwargs)
+
+def _evaluate_experiment_in_worker(args):
+    k,x = args
+    return _experiment_worker_set.evaluateExperiment(k, x)
+
+class ExperimentSet(Evaluator):
+    '''
+    Evaluates one parameter vector against several experiments on the
+    same model. The objective is the MSE over the residuals of all
+    experiments. By default all experiments share a single RoadRunner
+    instance and are simulated one after the other. With parallel='threads',
+    each experiment gets its own instance (cloned from the model cache,
+    so the model is still compiled once). With parallel='processes',
+    experiments are distributed over a pool of worker processes, each of
+    which holds its own serial ExperimentSet (the parent process keeps
+    a single instance).
+    '''
+    def __init__(self, sbml, experiments, param_list=None, parallel=None, processes=None, **model_kwargs):
+        # type: (str, typing.Sequence[Experiment], typing.Optional[typing.Sequence[str]], typing.Optional[str], typing.Optional[int], typing.Any) -> None
+        '''
+        Constructor.
+
+        :param experiments: A list of Experiment.
+        :param parallel: None, 'threads', or 'processes'.
+        :param processes: Number of threads or processes to use. Defaults to the number of experiments.
+        :param model_kwargs: Passed on to each TimecourseModel (e.g. log_params, solver_config).
+        '''
+        expect(len(experiments) > 0, 'Need at least one experiment')
+        expect(parallel in (None, 'threads', 'processes'), 'Unknown parallel mode {}'.format(parallel))
+        self.sbml = sbml
+        self.experiments = list(experiments)
+        self.param_list = param_list
+        self.parallel = parallel
+        self.processes = processes or len(self.experiments)
+        self.model_kwargs = model_kwargs
+        self._executor = None
+
+        # with processes, the models here are only used for bookkeeping
+        # (n_residuals, penalty), the workers build their own
+        shared = get_model(sbml) if parallel != 'threads' else None
+        # pre-equilibration only depends on the parameters (initial conditions
+        # are applied afterwards), so experiments on one instance share the cache
+        kwargs = dict(model_kwargs)
+        if shared is not None and kwargs.get('preequilibrate'):
+            kwargs.setdefault('steady_state_cache', SteadyStateCache())
+        self.models = [TimecourseModel(
+            sbml,
+            e.data_quantities,
+            e.measurement_map,
+            param_list=param_list,
+            initial_conditions=e.initial_conditions,
+            model=shared,
+            **kwargs) for e in self.experiments]
+        self.n_residuals = sum(m.n_residuals for m in self.models)
+        self.penalty = self.models[0].solver_config.penalty
+
+    def evaluateExperiment(self, k, x):
+        # type: (int, array) -> typing.Optional[float]
+        '''
+        Returns the sum of squared residuals of experiment k,
+        or None if the simulation failed.
+        '''
+        m = self.models[k]
+        penalties = m.penalty_evaluations
+        f = m.evaluate(x)
+        if m.penalty_evaluations > penalties:
+            return None
+        return f*m.n_residuals
+
+    def _getExecutor(self):
+        if self._executor is None:
+            if self.parallel == 'threads':
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(self.processes)
+            else:
+                from multiprocessing import Pool
+                self._executor = Pool(
+                    self.processes,
+                    initializer=_init_experiment_worker,
+                    initargs=(self.sbml, self.experiments, self.param_list, self.model_kwargs))
+                import atexit
+                atexit.register(self.close)
+        return self._executor
+
+    def evaluate(self, x):
+        # type: (array) -> float
+        indices = range(len(self.models))
+        if self.parallel is None:
+            sse = [self.evaluateExperiment(k, x) for k in indices]
+        elif self.parallel == 'threads':
+            sse = list(self._getExecutor().map(lambda k: self.evaluateExperiment(k, x), indices))
+        else:
+            sse = self._getExecutor().map(_evaluate_experiment_in_worker, [(k,x) for k in indices])
+        if any(s is None for s in sse):
+            return self.penalty
+        return sum(sse)/self.n_residuals
+
+    def close(self):
+        if self._executor is not None:
+            if self.parallel == 'threads':
+                self._executor.shutdown()
+            else:
+                self._executor.close()
+                self._executor.join()
+            self._executor = None
+
+    def __getstate__(self):
+        # models and workers are rebuilt on the receiving side
+        return {
+          'sbml': self.sbml,
+          'experiments': self.experiments,
+          'param_list': self.param_list,
+          'parallel': self.parallel,
+          'processes': self.processes,
+          'model_kwargs': self.model_kwargs}
+
+    def __setstate__(self, state):
+        self.__init__(
+            state['sbml'],
+            state['experiments'],
+            state['param_list'],
+            state['parallel'],
+            state['processes'],
+            **state['model_kwargs'])
@@ -0,0 +1,73 @@
+# Sabaody
+# Copyright 2018 J Kyle Medley
+from __future__ import print_function, division, absolute_import
+
+from numpy import asarray, frombuffer, ndarray
+from json import dumps, loads
+import struct
+import typing
+
+# content type used to negotiate the binary format over HTTP
+MIGRANTS_CONTENT_TYPE = 'application/x-sabaody-migrants'
+
+_MAGIC = b'SBMG'
+_VERSION = 1
+# magic, version, reserved, number of migrants, vector size, metadata size
+_HEADER = struct.Struct('<4sHHIII')
+
+def encode_migrants(migrants, fitness, meta=None):
+    # type: (ndarray, ndarray, typing.Optional[typing.Dict]) -> bytes
+    '''
+    Encodes a block of migrants as a single binary frame: a
+    fixed-size header, the migrant vectors (in rows) and fitness
+    values as little-endian float64, and a short JSON metadata
+    block for strings (e.g. source island ids).
+    '''
+    migrants = asarray(migrants, dtype='<f8')
+    if migrants.ndim == 1:
+        migrants = migrants.reshape(1,-1)
+    fitness = asarray(fitness, dtype='<f8').reshape(-1)
+    if migrants.shape[0] != fitness.size:
+        raise RuntimeError('Got {} migrants but {} fitness values'.format(migrants.shape[0], fitness.size))
+    meta_bytes = dumps(meta).encode('utf8') if meta else b''
+    return b''.join((
+        _HEADER.pack(_MAGIC, _VERSION, 0, migrants.shape[0], migrants.shape[1], len(meta_bytes)),
+        migrants.tobytes(),
+        fitness.tobytes(),
+        meta_bytes))
+
+def encode_migrant_frames(frames):
+    # type: (typing.Iterable[typing.Tuple[ndarray,ndarray,typing.Optional[typing.Dict]]]) -> bytes
+    '''
+    Encodes several blocks of migrants into one message.
+    '''
+    return b''.join(encode_migrants(migrants, fitness, meta) for migrants,fitness,meta in frames)
+
+def decode_migrant_frames(data):
+    # type: (bytes) -> typing.List[typing.Tuple[ndarray,ndarray,typing.Dict]]
+    '''
+    Decodes a message into a list of (migrants, fitness, metadata)
+    tuples. The arrays are read-only views into data.
+    '''
+    data = memoryview(data)
+    frames = []
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < _HEADER.size:
+            raise RuntimeError('Truncated migrant frame header')
+        magic,version,_,n,d,meta_size = _HEADER.unpack_from(data, offset)
+        if magic != _MAGIC:
+            raise RuntimeError('Not a migrant frame')
+        if version != _VERSION:
+            raise RuntimeError('Unsupported migrant frame version {}'.format(version))
+        offset += _HEADER.size
+        if len(data) - offset < 8*(n*d+n) + meta_size:
+            raise RuntimeError('Truncated migrant frame')
+        migrants = frombuffer(data, dtype='<f8', count=n*d, offset=offset).reshape(n,d)
+        offset += 8*n*d
+        fitness = frombuffer(data, dtype='<f8', count=n, offset=offset)
+        offset += 8*n
+        meta = loads(bytes(data[offset:offset+meta_size]).decode('utf8')) if meta_size else {}
+        offset += meta_size
+        frames.append((migrants,fitness,meta))
+    return frames
@@ -3,13 +3,17 @@ from __future__ import print_function, division, absolute_import
 from sabaody.scripts.migration.kafka_migration_service import KafkaMigration
 from .topology import Topology, DiTopology
 
-from numpy import argsort, flipud, ndarray
+from numpy import argsort, argpartition, argmin, arange, flatnonzero, searchsorted, vstack, ndarray
+from numpy.random import default_rng
 import pygmo as pg
 import arrow
 
 from abc import ABC, abstractmethod
+import logging
 import typing
 
+logger = logging.getLogger(__name__)
+
 class SelectionPolicyBase(ABC):
     '''
     Selects migrants to be sent to other islands.
@@ -27,15 +31,57 @@ class ReplacementPolicyBase(ABC):
     def replace(self, population, candidates, candidate_f):
         pass
 
-def sort_by_fitness(population):
+class PopulationSnapshot:
+    '''
+    Decision vectors and fitness values of a pygmo population,
+    copied out once and kept in sync on replacement. Can be
+    passed to the selection and replacement policies in place
+    of the population so a migration round copies the
+    population only once.
+    '''
+    def __init__(self, population):
+        self.population = population
+        self.x = population.get_x()
+        self.f = population.get_f()
+
+    def get_x(self):
+        return self.x
+
+    def get_f(self):
+        return self.f
+
+    def set_xf(self, i, x, f):
+        self.population.set_xf(i, x, f)
+        self.x[i] = x
+        self.f[i] = f
+
+def best_indices(f, n):
+    # type: (ndarray, int) -> ndarray
+    '''
+    Returns the indices of the n smallest values in the 1D
+    array f, best first. Uses a partial sort, so the cost is
+    linear in the size of f plus n log n.
+    '''
+    n = min(n, f.size)
+    if n < f.size:
+        indices = argpartition(f, n-1)[:n] if n > 0 else arange(0)
+    else:
+        indices = arange(f.size)
+    return indices[argsort(f[indices], kind='stable')]
+
+def sort_by_fitness(population, n=None, f=None):
     '''
     Returns a tuple of the decision vectors and corresponding
     fitness values, both sorted according to fitness (best
-    first).
+    first). If n is given, only return the best n. If the
+    caller already has the fitness values of the population,
+    it can pass them as f to avoid another copy.
     '''
-    indices = argsort(population.get_f(), axis=0)
-    return (population.get_x()[indices[:,0]],
-            population.get_f()[indices[:,0]])
+    if f is None:
+        f = population.get_f()
+    indices = best_indices(f[:,0], f.shape[0] if n is None else n)
+    return (population.get_x()[indices],
+            f[indices])
 
 def sort_candidates_by_fitness(candidates,candidate_f):
     if candidates.size == 0:
@@ -46,10 +92,10 @@ def sort_candidates_by_fitness(candidates,candidate_f):
             candidate_f[indices[:,0]])
 
 # ** Selection Policies **
-class BestSPolicy(SelectionPolicyBase):
+class RateSelectionPolicy(SelectionPolicyBase):
     '''
-    Selection policy.
-    Selects the best N individuals from a population.
+    Base class for selection policies which select
+    either a fixed number or a fraction of the population.
     '''
     def __init__(self, migration_rate=None, pop_fraction=None):
         if migration_rate is None and pop_fraction is None:
@@ -59,6 +105,15 @@ class BestSPolicy(SelectionPolicyBase):
         self.migration_rate = migration_rate
         self.pop_fraction = pop_fraction
 
+    def getMigrantCount(self, pop_size):
+        # type: (int) -> int
+        return min(self.migration_rate or int(pop_size*self.pop_fraction), pop_size)
+
+class BestSPolicy(RateSelectionPolicy):
+    '''
+    Selection policy.
+    Selects the best N individuals from a population.
+    '''
     def select(self, population):
         '''
         Selects the top pop_fraction*population_size
@@ -70,11 +125,48 @@ class BestSPolicy(SelectionPolicyBase):
         The returned array of candidates should be sorted descending
         according to best fitness value.
         '''
-        indices = argsort(population.get_f(), axis=0)
-        n_migrants = self.migration_rate or int(indices.size*self.pop_fraction)
+        f = population.get_f()
+        n_migrants = self.getMigrantCount(f.shape[0])
         # WARNING: single objective only
-        return (population.get_x()[indices[:n_migrants,0]],
-                population.get_f()[indices[:n_migrants,0]])
+        return sort_by_fitness(population, n_migrants, f)
+
+class RandomSPolicy(RateSelectionPolicy):
+    '''
+    Selection policy.
+    Selects N individuals uniformly at random (without replacement).
+    '''
+    def __init__(self, migration_rate=None, pop_fraction=None, seed=None):
+        super().__init__(migration_rate, pop_fraction)
+        self.rng = default_rng(seed)
+
+    def select(self, population):
+        f = population.get_f()
+        indices = self.rng.choice(f.shape[0], self.getMigrantCount(f.shape[0]), replace=False)
+        return (population.get_x()[indices], f[indices])
+
+class TournamentSPolicy(RateSelectionPolicy):
+    '''
+    Selection policy.
+    Selects N individuals by tournament: each migrant is the best
+    of tournament_size individuals drawn at random. The same
+    individual can win more than one tournament.
+    '''
+    def __init__(self, migration_rate=None, pop_fraction=None, tournament_size=2, seed=None):
+        super().__init__(migration_rate, pop_fraction)
+        if tournament_size < 1:
+            raise RuntimeError('Tournament size must be at least one.')
+        self.tournament_size = tournament_size
+        self.rng = default_rng(seed)
+
+    def select(self, population):
+        f = population.get_f()
+        n_migrants = self.getMigrantCount(f.shape[0])
+        if n_migrants == 0:
+            return (population.get_x()[:0], f[:0])
+        # one tournament per row
+        entrants = self.rng.integers(f.shape[0], size=(n_migrants, self.tournament_size))
+        winners = entrants[arange(n_migrants), argmin(f[entrants,0], axis=1)]
+        return (population.get_x()[winners], f[winners])
 
 # ** Replacement Policies **
 class FairRPolicy(ReplacementPolicyBase):
@@ -94,34 +186,162 @@ class FairRPolicy(ReplacementPolicyBase):
         '''
         # sort candidates
         candidates,candidate_f = sort_candidates_by_fitness(candidates,candidate_f)
-        indices = flipud(argsort(population.get_f(), axis=0))
-        pop_f = population.get_f()
-        deltas = []
-        for i,k,f in zip(indices[:,0],range(len(candidate_f)),candidate_f):
-            if f < pop_f[i,0]:
-                population.set_xf(int(i),candidates[k,:],f)
-                deltas.append(float(f - pop_f[i,0]))
-            else:
-                pass
-                # break
-        return deltas
+        pop_f = population.get_f()[:,0]
+        n = min(candidate_f.shape[0], pop_f.size)
+        if n == 0:
+            return []
+        # the n worst individuals, worst first
+        worst = best_indices(-pop_f, n)
+        # pair the best candidate with the worst individual and so on
+        f = candidate_f[:n,0]
+        better = flatnonzero(f < pop_f[worst])
+        deltas = f[better] - pop_f[worst[better]]
+        # only the replaced rows are written back
+        for k in better:
+            population.set_xf(int(worst[k]), candidates[k,:], candidate_f[k,:])
+        return deltas.tolist()
+
+class WorstRPolicy(ReplacementPolicyBase):
+    '''
+    Worst replacement policy.
+    Unconditionally replaces the worst N individuals in the
+    population with the N candidates.
+    '''
+
+    def replace(self, population, candidates, candidate_f):
+        '''
+        If there are more candidates than individuals,
+        only the best candidates are used.
+
+        :return: The deltas of the replacements made
+        :param candidates: Numpy 2D array with candidates in rows.
+        '''
+        candidates,candidate_f = sort_candidates_by_fitness(candidates,candidate_f)
+        pop_f = population.get_f()[:,0]
+        n = min(candidate_f.shape[0], pop_f.size)
+        if n == 0:
+            return []
+        worst = best_indices(-pop_f, n)
+        deltas = candidate_f[:n,0] - pop_f[worst]
+        for k in range(n):
+            population.set_xf(int(worst[k]), candidates[k,:], candidate_f[k,:])
+        return deltas.tolist()
+
+class RandomRPolicy(ReplacementPolicyBase):
+    '''
+    Random replacement policy.
+    Each candidate replaces an individual chosen at random
+    (without replacement) if the candidate is better.
+    '''
+    def __init__(self, seed=None):
+        self.rng = default_rng(seed)
+
+    def replace(self, population, candidates, candidate_f):
+        '''
+        :return: The deltas of the replacements made
+        :param candidates: Numpy 2D array with candidates in rows.
+        '''
+        pop_f = population.get_f()[:,0]
+        n = min(candidate_f.shape[0], pop_f.size)
+        if n == 0:
+            return []
+        targets = self.rng.choice(pop_f.size, n, replace=False)
+        f = candidate_f[:n,0]
+        better = flatnonzero(f < pop_f[targets])
+        deltas = f[better] - pop_f[targets[better]]
+        for k in better:
+            population.set_xf(int(targets[k]), candidates[k,:], candidate_f[k,:])
+        return deltas.tolist()
 
 # ** Migration Policies **
+class MigrationPolicyBase(ABC):
+    '''
+    Decides which of the selected migrants are sent
+    to which of the connected islands.
+    '''
+    @abstractmethod
+    def route(self, dest_island_ids, n_migrants):
+        # type: (typing.Sequence[str], int) -> typing.List[typing.Tuple[str,ndarray]]
+        '''
+        Returns a list of destination ids and the indices
+        of the migrants to send to each one.
+        '''
+        pass
+
+class MigrationPolicyEachToAll(MigrationPolicyBase):
+    '''
+    Sends every migrant to every connected island.
+    '''
+    def route(self, dest_island_ids, n_migrants):
+        indices = arange(n_migrants)
+        return [(id,indices) for id in dest_island_ids]
+
+class MigrationPolicyUniform(MigrationPolicyBase):
+    '''
+    Sends each migrant to one connected island chosen uniformly
+    at random, which reduces traffic by a factor of the out-degree.
+    '''
+    def __init__(self, seed=None):
+        self.rng = default_rng(seed)
+
+    def route(self, dest_island_ids, n_migrants):
+        dest_island_ids = list(dest_island_ids)
+        if not dest_island_ids:
+            return []
+        choice = self.rng.integers(len(dest_island_ids), size=n_migrants)
+        order = argsort(choice, kind='stable')
+        bounds = searchsorted(choice[order], arange(len(dest_island_ids)+1))
+        return [(id,order[bounds[k]:bounds[k+1]])
+                for k,id in enumerate(dest_island_ids) if bounds[k+1] > bounds[k]]
+
 class Migrator(ABC):
-    def __init__(self, selection_policy, replacement_policy):
+    def __init__(self, selection_policy, replacement_policy, migration_policy=None):
         self.selection_policy = selection_policy
         self.replacement_policy = replacement_policy
+        self.migration_policy = migration_policy if migration_policy is not None else MigrationPolicyEachToAll()
+
+    def migrate(self, island_id, island, topology):
+        # type: (str, pg.island, typing.Union[Topology,DiTopology]) -> typing.Tuple[typing.List,typing.List]
+        '''
+        Performs one migration round: sends migrants to the
+        connected islands, then replaces individuals with
+        incoming migrants. The population is copied out of
+        pygmo once and shared by selection and replacement.
+        '''
+        pop = island.get_population()
+        snapshot = PopulationSnapshot(pop)
+        self.sendSelectedMigrants(island_id, snapshot, topology)
+        deltas,src_ids = self.replace(island_id, snapshot)
+        if deltas:
+            island.set_population(pop)
+        return (deltas,src_ids)
 
     def sendMigrants(self, island_id, island, topology):
         # type: (str, pg.island, typing.Union[Topology,DiTopology]) -> None
         '''
         Sends migrants from a pagmo island to other connected islands.
         '''
-        pop = island.get_population()
-        candidates,candidate_f = self.selection_policy.select(pop)
-        for connected_island in topology.outgoing_ids(island_id):
-            for candidate,f in zip(candidates,candidate_f):
-                self.pushMigrant(connected_island, candidate, f, src_island_id=island_id)
+        self.sendSelectedMigrants(island_id, island.get_population(), topology)
+
+    def sendSelectedMigrants(self, island_id, population, topology):
+        # type: (str, typing.Union[pg.population,PopulationSnapshot], typing.Union[Topology,DiTopology]) -> None
+        '''
+        Selects migrants from the population and sends them
+        to the connected islands.
+        '''
+        self.pushMigrants(island_id, self.selectMigrants(island_id, population, topology))
+
+    def selectMigrants(self, island_id, population, topology):
+        # type: (str, typing.Union[pg.population,PopulationSnapshot], typing.Union[Topology,DiTopology]) -> typing.List[typing.Tuple[str,ndarray,ndarray]]
+        '''
+        Selects migrants from the population and routes them to
+        the connected islands. Returns a list of destination ids,
+        migrant vectors and fitness values (see pushMigrants).
+        '''
+        candidates,candidate_f = self.selection_policy.select(population)
+        routes = self.migration_policy.route(topology.outgoing_ids(island_id), candidates.shape[0])
+        return [(dest_island_id, candidates[indices], candidate_f[indices])
+                for dest_island_id,indices in routes]
 
     def send_migrants(self, island_id, island, topology,generation=1):
         # type: (str, pg.island, typing.Union[Topology,DiTopology]) -> None
@@ -179,10 +399,21 @@ class Migrator(ABC):
         return (self.replacement_policy.replace(population,candidates,candidate_f),src_ids)
 
     @abstractmethod
-    def pushMigrant(self, dest_island_id, migrant_vector, fitness, src_island_id=None, expiration_time=arrow.utcnow().shift(days=+1)):
-        # type: (str, ndarray, float, str, arrow.Arrow) -> None
+    def pushMigrant(self, dest_island_id, migrant_vector, fitness, src_island_id=None, expiration_time=None):
+        # type: (str, ndarray, float, str, typing.Optional[arrow.Arrow]) -> None
         pass
 
+    def pushMigrants(self, src_island_id, pushes):
+        # type: (str, typing.Sequence[typing.Tuple[str,ndarray,ndarray]]) -> None
+        '''
+        Pushes migrants to several islands. pushes is a sequence of
+        destination island ids, migrant vectors (in rows) and fitness
+        values. Subclasses can override this to send everything at once.
+        '''
+        for dest_island_id,migrants,fitness in pushes:
+            for migrant_vector,f in zip(migrants,fitness):
+                self.pushMigrant(dest_island_id, migrant_vector, f, src_island_id=src_island_id)
+
     @abstractmethod
     def pullMigrants(self, island_id, n=0):
         # type: (ndarray, int) -> typing.Tuple[ndarray,ndarray,typing.List[str]]
@@ -192,3 +423,103 @@ class Migrator(ABC):
     def pull_migrants(self,island_id, buffer_length, generation=1):
         return KafkaMigration.welcome(island_id,buffer_length,generation)
 
+
+
+class BackgroundMigrator:
+    '''
+    Performs the network side of migration for one island on a
+    background thread, so evolution and migration can overlap.
+    Outgoing migrants are queued and pushed in the background,
+    each send is followed by a pull of the island's pool, and
+    incoming migrants are applied whenever receiveMigrants is
+    called (typically at the start of the next round).
+    Failures in the background are logged, and the first one
+    is re-raised by the next call to receiveMigrants or close.
+    '''
+    def __init__(self, migrator, island_id, topology):
+        # type: (Migrator, str, typing.Union[Topology,DiTopology]) -> None
+        from threading import Thread, Lock
+        from queue import Queue
+        self.migrator = migrator
+        self.island_id = island_id
+        self.topology = topology
+        self._tasks = Queue()
+        self._lock = Lock()
+        self._incoming = []
+        # first exception raised by a background task (not yet re-raised)
+        self.error = None
+        # number of failed background tasks
+        self.n_errors = 0
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                task()
+            except Exception as e:
+                logger.exception('Background migration failed for island {}'.format(self.island_id))
+                with self._lock:
+                    self.n_errors += 1
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self._tasks.task_done()
+
+    def raiseError(self):
+        '''
+        Re-raises the first failure of a background task, if any.
+        '''
+        with self._lock:
+            error,self.error = self.error,None
+        if error is not None:
+            raise error
+
+    def _pull(self):
+        candidates,candidate_f,src_ids = self.migrator.pullMigrants(self.island_id)
+        if len(candidates) > 0:
+            with self._lock:
+                self._incoming.append((candidates,candidate_f,src_ids))
+
+    def sendMigrants(self, population):
+        # type: (typing.Union[pg.population,PopulationSnapshot]) -> None
+        '''
+        Selects migrants now and queues them to be sent,
+        followed by a pull of incoming migrants.
+        '''
+        pushes = self.migrator.selectMigrants(self.island_id, population, self.topology)
+        self._tasks.put(lambda: self.migrator.pushMigrants(self.island_id, pushes))
+        self._tasks.put(self._pull)
+
+    def receiveMigrants(self, population):
+        # type: (typing.Union[pg.population,PopulationSnapshot]) -> typing.Tuple[typing.List,typing.List]
+        '''
+        Applies the migrants that have arrived so far
+        (without waiting for pending pulls).
+        '''
+        self.raiseError()
+        with self._lock:
+            incoming,self._incoming = self._incoming,[]
+        if not incoming:
+            return ([],[])
+        candidates = vstack([c for c,f,ids in incoming])
+        candidate_f = vstack([f for c,f,ids in incoming])
+        src_ids = [id for c,f,ids in incoming for id in ids]
+        return (self.migrator.replacement_policy.replace(population,candidates,candidate_f),src_ids)
+
+    def flush(self):
+        '''
+        Waits for all queued sends and pulls.
+        '''
+        self._tasks.join()
+
+    def close(self):
+        '''
+        Sends any pending migrants and stops the background thread.
+        '''
+        self._tasks.put(None)
+        self._thread.join()
+        self.raiseError()
@@ -4,24 +4,90 @@ from __future__ import print_function, division, absolute_import
 
 from .migration import Migrator
 from .topology import Topology, DiTopology
+from .migrant_codec import MIGRANTS_CONTENT_TYPE, encode_migrants, encode_migrant_frames, decode_migrant_frames
 
 #from requests import post
 from yarl import URL
 import attr
-from numpy import array, ndarray, argsort, transpose
+from numpy import array, asarray, ndarray, argsort, transpose, empty, concatenate
 from tornado.web import Application, RequestHandler
 from tornado.escape import json_decode
 import arrow
 
-from collections import deque
+from collections import deque, OrderedDict
+from heapq import heapify, heapreplace, heappush, heappop
+from itertools import count
 from abc import ABC, abstractmethod
+from zlib import crc32
+import logging
 import typing
 
+logger = logging.getLogger(__name__)
+
 # ** Client Logic **
+def default_expiration_time(expiration_time=None):
+    # type: (typing.Optional[arrow.Arrow]) -> arrow.Arrow
+    '''
+    Returns expiration_time, or one day from now if it is None.
+    Must be called when a request is made: a default argument
+    would be evaluated once at import time, and a long-running
+    client would then define pools that have already expired.
+    '''
+    return arrow.utcnow().shift(days=+1) if expiration_time is None else expiration_time
+
+def island_shard(island_id, n_shards):
+    # type: (str, int) -> int
+    '''
+    Index of the service shard (worker process) that owns an island.
+    Must be stable across processes, so Python's hash is not used.
+    '''
+    return crc32(str(island_id).encode('utf8')) % n_shards
+
 class CentralMigrator(Migrator):
-    def __init__(self, root_url, selection_policy, migration_policy):
-        super().__init__(selection_policy, migration_policy)
+    def __init__(self, root_url, selection_policy, replacement_policy, migration_policy=None, wire_format='binary', shards=1):
+        '''
+        :param wire_format: How migrants are encoded on the wire, either 'binary' (see migrant_codec) or 'json'.
+        :param shards: Number of worker processes of the service (see run_migration_service). Shard k listens on the port of root_url plus k.
+        '''
+        super().__init__(selection_policy, replacement_policy, migration_policy)
+        if wire_format not in ('binary', 'json'):
+            raise RuntimeError('Unknown wire format {}'.format(wire_format))
         self.root_url = URL(root_url)
+        self.wire_format = wire_format
+        self.shards = shards
+        self.shard_urls = [self.root_url.with_port(self.root_url.port+k) for k in range(shards)]
+        self._session = None
+
+    @property
+    def session(self):
+        '''
+        Persistent HTTP session, so connections to the
+        server are pooled and reused across requests.
+        '''
+        if self._session is None:
+            from requests import Session
+            self._session = Session()
+        return self._session
+
+    def __getstate__(self):
+        # sessions hold open sockets, create a new one on the receiving side
+        state = self.__dict__.copy()
+        state['_session'] = None
+        return state
+
+    def urlFor(self, island_id):
+        # type: (str) -> URL
+        '''
+        Root url of the shard that owns the island.
+        '''
+        return self.shard_urls[island_shard(island_id, self.shards)]
+
+    def groupByShard(self, island_ids):
+        # type: (typing.Iterable[str]) -> typing.Dict[URL,typing.List[str]]
+        groups = {}
+        for id in island_ids:
+            groups.setdefault(self.urlFor(id), []).append(id)
+        return groups
 
     def purgeAll(self):
         # type: () -> None
@@ -29,23 +95,38 @@ class CentralMigrator(Migrator):
         Wipe the island definitions and all migrants.
         Return to state at service startup.
         '''
-        from requests import post
-        r = post(str(self.root_url / 'purge-all'))
-        r.raise_for_status()
+        for url in self.shard_urls:
+            r = self.session.post(str(url / 'purge-all'))
+            r.raise_for_status()
 
-    def defineMigrantPool(self, id, param_vector_size, buffer_type='FIFO', expiration_time=arrow.utcnow().shift(days=+1)):
-        # type: (str, int, str, arrow.Arrow) -> None
+    def stats(self):
+        # type: () -> typing.Dict[str,int]
+        '''
+        Number of live pools, migrants held and pools evicted
+        by garbage collection, summed over all shards.
+        '''
+        totals = {'pools': 0, 'migrants': 0, 'evicted': 0}
+        for url in self.shard_urls:
+            r = self.session.get(str(url / 'stats'))
+            r.raise_for_status()
+            shard_stats = r.json()
+            for k in totals:
+                totals[k] += shard_stats[k]
+        return totals
+
+    def defineMigrantPool(self, id, param_vector_size, buffer_type='FIFO', expiration_time=None):
+        # type: (str, int, str, typing.Optional[arrow.Arrow]) -> None
         '''
         Sends an island definition to the server.
 
         :param self.root_url: The url of the server, e.g. http://localhost:10100.
         :param id: The id of the island/pool to be created (one pool per island).
         :param param_vector_size: The size of the parameter vector for the island/pool. Will be used to check pushed migrant vectors.
-        :param buffer_type: Type of migration buffer to use. Can be 'FIFO'.
-        :param expiration_time: The time when the pool should expire and be garbage collected. Should be longer than expected run time of fitting task.
+        :param buffer_type: Type of migration buffer to use. Can be 'FIFO', 'RING' or 'BEST'.
+        :param expiration_time: The time when the pool should expire and be garbage collected. Should be longer than expected run time of fitting task. Defaults to one day from now.
         '''
-        from requests import post
-        r = post(str(self.root_url / 'define-island' / str(id)),
+        expiration_time = default_expiration_time(expiration_time)
+        r = self.session.post(str(self.urlFor(id) / 'define-island' / str(id)),
                 json={
                   'param_vector_size': param_vector_size,
                   'buffer_type': buffer_type,
@@ -53,50 +134,143 @@ class CentralMigrator(Migrator):
                   })
         r.raise_for_status()
 
-    def defineMigrantPools(self, topology, param_vector_size, buffer_type='FIFO', expiration_time=arrow.utcnow().shift(days=+1)):
-        # type: (typing.Union[Topology,DiTopology], int, str, arrow.Arrow) -> None
+    def defineMigrantPools(self, topology, param_vector_size, buffer_type='FIFO', expiration_time=None):
+        # type: (typing.Union[Topology,DiTopology], int, str, typing.Optional[arrow.Arrow]) -> None
         '''
         Defines migrant pools for every island in the topology.
         '''
+        expiration_time = default_expiration_time(expiration_time)
         for id in topology.island_ids:
             self.defineMigrantPool(id, param_vector_size=param_vector_size, buffer_type=buffer_type, expiration_time=expiration_time)
 
-    def pushMigrant(self, dest_island_id, migrant_vector, fitness, src_island_id = None, expiration_time=arrow.utcnow().shift(days=+1)):
-        # type: (str, ndarray, float, str, arrow.Arrow) -> None
+    def pushMigrant(self, dest_island_id, migrant_vector, fitness, src_island_id = None, expiration_time=None):
+        # type: (str, ndarray, float, str, typing.Optional[arrow.Arrow]) -> None
         '''
         Sends an island definition to the server.
 
-        :param expiration_time: If set, updates the expiration time of the pool.
+        :param expiration_time: Extends the lifetime of the pool to at least this time. Defaults to one day from now.
         '''
+        expiration_time = default_expiration_time(expiration_time)
         extra_args = dict()
         if src_island_id is not None:
             extra_args['src_island_id'] = src_island_id
-        from requests import post
-        r = post(str(self.root_url / str(dest_island_id) / 'push-migrant'),
+        if self.wire_format == 'binary':
+            meta = dict(extra_args, expiration_time=arrow.get(expiration_time).isoformat())
+            r = self.session.post(str(self.urlFor(dest_island_id) / str(dest_island_id) / 'push-migrant'),
+                    data=encode_migrants(migrant_vector, fitness, meta),
+                    headers={'Content-Type': MIGRANTS_CONTENT_TYPE})
+            r.raise_for_status()
+            return
+        r = self.session.post(str(self.urlFor(dest_island_id) / str(dest_island_id) / 'push-migrant'),
                 json={
                   'migrant_vector': migrant_vector.tolist(),
-                  'fitness': float(fitness),
+                  'fitness': float(asarray(fitness, dtype=float).reshape(-1)[0]),
                   'expiration_time': arrow.get(expiration_time).isoformat(),
                   **extra_args
                   })
         r.raise_for_status()
 
-    def pullMigrants(self, island_id, n=0):
-        # type: (array, int) -> typing.Tuple[ndarray,ndarray,typing.List[str]]
+    def pushMigrants(self, src_island_id, pushes, expiration_time=None):
+        # type: (str, typing.Sequence[typing.Tuple[str,ndarray,ndarray]], typing.Optional[arrow.Arrow]) -> None
+        '''
+        Sends migrants for any number of destination islands
+        in a single request (one per shard).
+
+        :param pushes: A sequence of destination island ids, migrant vectors (in rows) and fitness values.
+        :param expiration_time: Extends the lifetime of the pools to at least this time. Defaults to one day from now.
+        '''
+        expiration_time = default_expiration_time(expiration_time)
+        pushes = [(dest_island_id,migrants,fitness) for dest_island_id,migrants,fitness in pushes if len(migrants) > 0]
+        if self.shards > 1:
+            by_shard = {}
+            for push in pushes:
+                by_shard.setdefault(island_shard(push[0], self.shards), []).append(push)
+            for shard_pushes in by_shard.values():
+                self.pushShardMigrants(src_island_id, shard_pushes, expiration_time)
+        elif pushes:
+            self.pushShardMigrants(src_island_id, pushes, expiration_time)
+
+    def pushShardMigrants(self, src_island_id, pushes, expiration_time):
+        # type: (str, typing.Sequence[typing.Tuple[str,ndarray,ndarray]], arrow.Arrow) -> None
+        '''
+        Sends migrants for islands that belong to the same shard.
+        '''
+        url = self.urlFor(pushes[0][0]) / 'push-migrants'
+        if self.wire_format == 'binary':
+            meta = {'expiration_time': arrow.get(expiration_time).isoformat()}
+            if src_island_id is not None:
+                meta['src_island_id'] = str(src_island_id)
+            r = self.session.post(str(url),
+                    data=encode_migrant_frames(
+                      (migrants, fitness, dict(meta, dest_island_id=str(dest_island_id)))
+                      for dest_island_id,migrants,fitness in pushes),
+                    headers={'Content-Type': MIGRANTS_CONTENT_TYPE})
+            r.raise_for_status()
+            return
+        args = {
+          'pushes': [{
+              'dest_island_id': str(dest_island_id),
+              'migrants': asarray(migrants, dtype=float).tolist(),
+              'fitness': asarray(fitness, dtype=float).reshape(-1).tolist(),
+            } for dest_island_id,migrants,fitness in pushes],
+          'expiration_time': arrow.get(expiration_time).isoformat(),
+          }
+        if src_island_id is not None:
+            args['src_island_id'] = str(src_island_id)
+        r = self.session.post(str(url), json=args)
+        r.raise_for_status()
+
+    def pullMigrants(self, island_id, n=0, min_count=0, timeout=0.):
+        # type: (array, int, int, float) -> typing.Tuple[ndarray,ndarray,typing.List[str]]
         '''
         Gets n migrants from the pool and returns them.
         If n is zero, return all migrants.
+        If min_count and timeout are given, the server holds the
+        request until the pool has at least min_count migrants
+        or timeout seconds have passed.
         '''
-        from requests import post
-        r = post(str(self.root_url / str(island_id) / 'pop-migrants'),
-                json={
-                  'n': n,
-                  })
+        headers = {'Accept': MIGRANTS_CONTENT_TYPE} if self.wire_format == 'binary' else {}
+        args = {'n': n}
+        if min_count > 0 and timeout > 0.:
+            args.update(min_count=min_count, timeout=timeout)
+        r = self.session.post(str(self.urlFor(island_id) / str(island_id) / 'pop-migrants'),
+                json=args,
+                headers=headers)
         r.raise_for_status()
+        if r.headers.get('Content-Type', '').startswith(MIGRANTS_CONTENT_TYPE):
+            migrants,fitness,meta = decode_migrant_frames(r.content)[0]
+            return (array(migrants),
+                    array(fitness).reshape(-1,1),
+                    meta.get('src_island_id', []))
         return (array(r.json()['migrants']),
                 array([[f] for f in r.json()['fitness']]),
                 r.json()['src_island_id'])
 
+    def pullMigrantsBulk(self, island_ids, n=0):
+        # type: (typing.Sequence[str], int) -> typing.Dict[str,typing.Tuple[ndarray,ndarray,typing.List[str]]]
+        '''
+        Gets up to n migrants (all if n is zero) from the pools of
+        several islands in one request per shard. Returns a dictionary
+        mapping island ids to migrants, fitness values and source ids.
+        '''
+        headers = {'Accept': MIGRANTS_CONTENT_TYPE} if self.wire_format == 'binary' else {}
+        result = {}
+        for url,ids in self.groupByShard(island_ids).items():
+            r = self.session.post(str(url / 'pop-migrants'),
+                    json={
+                      'island_ids': [str(id) for id in ids],
+                      'n': n,
+                      },
+                    headers=headers)
+            r.raise_for_status()
+            if r.headers.get('Content-Type', '').startswith(MIGRANTS_CONTENT_TYPE):
+                for migrants,fitness,meta in decode_migrant_frames(r.content):
+                    result[meta['island_id']] = (array(migrants), array(fitness).reshape(-1,1), meta.get('src_island_id', []))
+            else:
+                for id,m in r.json()['islands'].items():
+                    result[id] = (array(m['migrants']), array([[f] for f in m['fitness']]), m['src_island_id'])
+        return result
+
 # ** Server Logic **
 class MigrationBuffer(ABC):
     @abstractmethod
@@ -107,6 +281,21 @@ class MigrationBuffer(ABC):
     def pop(self, n=1):
         pass
 
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    def popArrays(self, n=0):
+        # type: (int) -> typing.Tuple[ndarray,ndarray,typing.List[str]]
+        '''
+        Like pop, but returns the migrants as a 2D array, an
+        array of fitness values and a list of source ids.
+        '''
+        migrants = self.pop(n)
+        return (array([v for v,fitness,src_id in migrants]).reshape(len(migrants), self.param_vector_size),
+                array([fitness for v,fitness,src_id in migrants], dtype=float),
+                [src_id for v,fitness,src_id in migrants])
+
 @attr.s
 class FIFOMigrationBuffer(MigrationBuffer):
     '''
@@ -139,11 +328,135 @@ class FIFOMigrationBuffer(MigrationBuffer):
         as a sequence.
         '''
         if n > 0:
-            return tuple(self._buf.pop() for x in range(n))
+            return tuple(self._buf.pop() for x in range(min(n, len(self._buf))))
         else:
             return tuple(self._buf.pop() for x in range(len(self._buf)))
 
-@attr.s(frozen=True)
+    def __len__(self):
+        return len(self._buf)
+
+@attr.s
+class RingMigrationBuffer(MigrationBuffer):
+    '''
+    Per-island buffer that stores incoming migrants in
+    preallocated arrays used as a ring buffer. Migrants are
+    popped oldest first. When full, a push overwrites the
+    oldest migrant.
+    '''
+    buffer_size = attr.ib(default=10)
+    # if zero, determined by first push
+    param_vector_size = attr.ib(default=0)
+    _migrants = attr.ib(default=None)
+    _fitness = attr.ib(default=None)
+    _src_ids = attr.ib(default=None)
+    # index of the oldest migrant
+    _head = attr.ib(default=0)
+    _count = attr.ib(default=0)
+
+    def __attrs_post_init__(self):
+        if self.param_vector_size > 0:
+            self._allocate()
+
+    def _allocate(self):
+        self._migrants = empty((self.buffer_size, self.param_vector_size))
+        self._fitness = empty(self.buffer_size)
+        self._src_ids = empty(self.buffer_size, dtype=object)
+
+    def push(self, param_vec, fitness, src_island_id=None):
+        # type: (ndarray, float, str) -> None
+        if self.param_vector_size == 0:
+            self.param_vector_size = param_vec.size
+            self._allocate()
+        elif param_vec.size != self.param_vector_size:
+            raise RuntimeError('Wrong length for parameter vector: expected {} but got {}'.format(self.param_vector_size, param_vec.size))
+        k = (self._head + self._count) % self.buffer_size
+        self._migrants[k] = param_vec
+        self._fitness[k] = fitness
+        self._src_ids[k] = src_island_id
+        if self._count == self.buffer_size:
+            # overwrote the oldest
+            self._head = (self._head + 1) % self.buffer_size
+        else:
+            self._count += 1
+
+    def _take(self, a, n):
+        # copies of at most two contiguous slices
+        end = self._head + n
+        if end <= self.buffer_size:
+            return a[self._head:end].copy()
+        return concatenate((a[self._head:], a[:end - self.buffer_size]))
+
+    def popArrays(self, n=0):
+        # type: (int) -> typing.Tuple[ndarray,ndarray,typing.List[str]]
+        n = self._count if n <= 0 else min(n, self._count)
+        if n == 0:
+            return (empty((0, self.param_vector_size)), empty(0), [])
+        result = (self._take(self._migrants, n),
+                  self._take(self._fitness, n),
+                  list(self._take(self._src_ids, n)))
+        self._head = (self._head + n) % self.buffer_size
+        self._count -= n
+        return result
+
+    def pop(self, n=0):
+        '''
+        Remove n migrants from the buffer (oldest first)
+        and return them as a sequence.
+        '''
+        migrants,fitness,src_ids = self.popArrays(n)
+        return tuple(zip(migrants, fitness, src_ids))
+
+    def __len__(self):
+        return self._count
+
+@attr.s
+class BestMigrationBuffer(MigrationBuffer):
+    '''
+    Per-island buffer that keeps only the buffer_size best
+    migrants (lowest fitness). Arrivals that are no better
+    than the worst retained migrant are discarded at push time.
+    Migrants are popped best first.
+    '''
+    buffer_size = attr.ib(default=10)
+    # if zero, determined by first push
+    param_vector_size = attr.ib(default=0)
+    # max-heap on fitness: (-fitness, sequence, param_vec, src_island_id)
+    _heap = attr.ib(default=attr.Factory(list))
+    # sequence numbers break ties so vectors are never compared
+    _sequence = attr.ib(default=attr.Factory(count))
+    discarded = attr.ib(default=0)
+
+    def push(self, param_vec, fitness, src_island_id=None):
+        # type: (ndarray, float, str) -> None
+        if self.param_vector_size == 0:
+            self.param_vector_size = param_vec.size
+        elif param_vec.size != self.param_vector_size:
+            raise RuntimeError('Wrong length for parameter vector: expected {} but got {}'.format(self.param_vector_size, param_vec.size))
+        entry = (-float(fitness), next(self._sequence), param_vec, src_island_id)
+        if len(self._heap) < self.buffer_size:
+            heappush(self._heap, entry)
+        elif entry[0] > self._heap[0][0]:
+            # better than the worst retained migrant
+            heapreplace(self._heap, entry)
+            self.discarded += 1
+        else:
+            self.discarded += 1
+
+    def pop(self, n=0):
+        '''
+        Remove the n best migrants from the buffer and
+        return them as a sequence, best first.
+        '''
+        entries = sorted(self._heap, reverse=True)
+        n = len(entries) if n <= 0 else min(n, len(entries))
+        self._heap = entries[n:]
+        heapify(self._heap)
+        return tuple((param_vec,-f,src_id) for f,_,param_vec,src_id in entries[:n])
+
+    def __len__(self):
+        return len(self._heap)
+
+@attr.s
 class LocalMigrantPool:
     '''
     Keeps track of all incoming migrants for a specific island.
@@ -163,6 +476,20 @@ class LocalMigrantPool:
     def pop(self, n=0):
         return self._buffer.pop(n)
 
+    def popArrays(self, n=0):
+        return self._buffer.popArrays(n)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def extendExpiration(self, expiration_time):
+        # type: (arrow.Arrow) -> None
+        '''
+        Moves the expiration time of the pool to expiration_time
+        if that is later. Never shortens the lifetime of the pool.
+        '''
+        self.expiration_time = max(self.expiration_time, arrow.get(expiration_time))
+
     @classmethod
     def FIFO(cls, param_vector_size, expiration_time):
         '''
@@ -170,6 +497,20 @@ class LocalMigrantPool:
         '''
         return cls(buffer=FIFOMigrationBuffer(param_vector_size=param_vector_size), expiration_time=expiration_time)
 
+    @classmethod
+    def RING(cls, param_vector_size, expiration_time):
+        '''
+        Constructs a LocalMigrantPool from a ring buffer.
+        '''
+        return cls(buffer=RingMigrationBuffer(param_vector_size=param_vector_size), expiration_time=expiration_time)
+
+    @classmethod
+    def BEST(cls, param_vector_size, expiration_time):
+        '''
+        Constructs a LocalMigrantPool from a best-k buffer.
+        '''
+        return cls(buffer=BestMigrationBuffer(param_vector_size=param_vector_size), expiration_time=expiration_time)
+
 class InvalidMigrantBufferType(KeyError):
     pass
 
@@ -180,13 +521,53 @@ class MigrationServiceHost:
     '''
     _migrant_pools = attr.ib(default=attr.Factory(dict))
     _migrant_pool_ctors = attr.ib(default={
-      'FIFO': LocalMigrantPool.FIFO
+      'FIFO': LocalMigrantPool.FIFO,
+      'RING': LocalMigrantPool.RING,
+      'BEST': LocalMigrantPool.BEST,
       })
     param_vector_size = attr.ib(default=0)
+    # this host only serves the islands of one shard, see run_migration_service
+    shard_index = attr.ib(default=0)
+    n_shards = attr.ib(default=1)
+    # pending long-poll requests per island: (min_count, future)
+    _waiters = attr.ib(default=attr.Factory(dict))
+    # min-heap of (expiration timestamp, island id), see garbageCollect
+    _expirations = attr.ib(default=attr.Factory(list))
+    # the heap entry that is current for each island
+    _scheduled_expirations = attr.ib(default=attr.Factory(dict))
+    # number of pools removed by garbage collection
+    evicted = attr.ib(default=0)
 
     def purgeAll(self):
         self._migrant_pools = {}
+        self._expirations = []
+        self._scheduled_expirations = {}
         self.param_vector_size = 0
+        # wake up all pending requests, they will fail on the missing pools
+        for id in list(self._waiters):
+            self.wakeWaiters(id)
+
+    def wakeWaiters(self, id):
+        '''
+        Resolves all pending long-poll requests for an island.
+        '''
+        for min_count,future in self._waiters.get(str(id), ()):
+            if not future.done():
+                future.set_result(None)
+
+    def scheduleExpiration(self, id, expiration_time):
+        # type: (str, arrow.Arrow) -> None
+        '''
+        Adds the expiration time of a pool to the heap, unless
+        an earlier entry is already scheduled for it. Later
+        expiration times are picked up when that entry comes due.
+        '''
+        id = str(id)
+        t = arrow.get(expiration_time).float_timestamp
+        if id in self._scheduled_expirations and self._scheduled_expirations[id] <= t:
+            return
+        self._scheduled_expirations[id] = t
+        heappush(self._expirations, (t,id))
 
     def defineMigrantPool(self, id, param_vector_size, buffer_type, expiration_time):
         '''
@@ -197,17 +578,93 @@ class MigrationServiceHost:
         elif param_vector_size != self.param_vector_size:
             raise RuntimeError('Wrong length for parameter vector: expected {} but got {}'.format(self.param_vector_size, param_vector_size))
         if not buffer_type in self._migrant_pool_ctors:
-            raise InvalidMigrantBufferType()
+            raise InvalidMigrantBufferType(buffer_type)
+        if island_shard(id, self.n_shards) != self.shard_index:
+            raise RuntimeError('Island {} does not belong to shard {}'.format(id, self.shard_index))
         self._migrant_pools[str(id)] = self._migrant_pool_ctors[buffer_type](param_vector_size=param_vector_size, expiration_time=arrow.get(expiration_time))
+        self.scheduleExpiration(id, expiration_time)
 
-    def pushMigrant(self, id, migrant_vector, fitness, src_island_id=None, expiration_time=arrow.utcnow().shift(days=+1)):
+    def pushMigrant(self, id, migrant_vector, fitness, src_island_id=None, expiration_time=None):
         '''
         Pushes a migrant vector to a pool.
+
+        :param expiration_time: If set, extends the lifetime of the pool to at least this time.
         '''
         migrant_vector = array(migrant_vector)
         if migrant_vector.size != self.param_vector_size:
             raise RuntimeError('Expected migrant vector of length {} but received length {}'.format(self.param_vector_size, migrant_vector.size))
-        self._migrant_pools[str(id)].push(migrant_vector, fitness, src_island_id)
+        pool = self._migrant_pools[str(id)]
+        pool.push(migrant_vector, fitness, src_island_id)
+        if expiration_time is not None:
+            pool.extendExpiration(expiration_time)
+        self.notifyWaiters(id)
+
+    def pushMigrants(self, pushes, src_island_id=None, expiration_time=None):
+        '''
+        Pushes migrants to several pools. Each entry in pushes
+        has a dest_island_id, a list of migrants, a list of
+        fitness values and optionally a src_island_id and
+        expiration_time (override the arguments). Everything
+        is validated before any migrant is pushed.
+        '''
+        batches = []
+        for push in pushes:
+            id = str(push['dest_island_id'])
+            src = push.get('src_island_id', src_island_id)
+            expiration = push.get('expiration_time', expiration_time)
+            migrants = array(push['migrants'], dtype=float).reshape(-1, self.param_vector_size)
+            fitness = array(push['fitness'], dtype=float)
+            if id not in self._migrant_pools:
+                raise RuntimeError('No such island {}'.format(id))
+            if migrants.shape[0] != fitness.size:
+                raise RuntimeError('Got {} migrants but {} fitness values'.format(migrants.shape[0], fitness.size))
+            batches.append((self._migrant_pools[id], migrants, fitness, src, expiration))
+        for pool,migrants,fitness,src,expiration in batches:
+            for migrant_vector,f in zip(migrants, fitness):
+                pool.push(migrant_vector, float(f), src)
+            if expiration is not None:
+                pool.extendExpiration(expiration)
+        for push in pushes:
+            self.notifyWaiters(push['dest_island_id'])
+
+    def notifyWaiters(self, id):
+        '''
+        Resolves the pending long-poll requests for an island
+        whose pool now has enough migrants.
+        '''
+        id = str(id)
+        if id not in self._waiters:
+            return
+        n_migrants = len(self._migrant_pools[id])
+        for min_count,future in self._waiters[id]:
+            if not future.done() and n_migrants >= min_count:
+                future.set_result(None)
+
+    async def waitForMigrants(self, id, min_count, timeout):
+        # type: (str, int, float) -> None
+        '''
+        Returns once the pool of the island holds at least min_count
+        migrants, or after timeout seconds. Does not poll: the wait
+        is a future which is resolved on push.
+        '''
+        from tornado.concurrent import Future
+        from tornado.gen import with_timeout
+        from tornado.util import TimeoutError
+        from datetime import timedelta
+        id = str(id)
+        if len(self._migrant_pools[id]) >= min_count:
+            return
+        future = Future()
+        waiter = (min_count,future)
+        self._waiters.setdefault(id, []).append(waiter)
+        try:
+            await with_timeout(timedelta(seconds=timeout), future)
+        except TimeoutError:
+            pass
+        finally:
+            self._waiters[id].remove(waiter)
+            if not self._waiters[id]:
+                del self._waiters[id]
 
     def popMigrants(self, id, n):
         '''
@@ -215,102 +672,267 @@ class MigrationServiceHost:
         '''
         return self._migrant_pools[str(id)].pop(n)
 
-    def garbageCollect(self):
+    def popMigrantArrays(self, id, n=0):
+        '''
+        Pops n migrants from the pool and returns them as arrays
+        (see MigrationBuffer.popArrays).
+        '''
+        return self._migrant_pools[str(id)].popArrays(n)
+
+    def popMigrantsBulk(self, island_ids, n=0, arrays=False):
+        '''
+        Pops up to n migrants from each of the given pools.
+        Checks that all pools exist before removing anything.
+        If arrays is true, the migrants of each pool are returned
+        as arrays (see popMigrantArrays).
+        '''
+        missing = [id for id in island_ids if str(id) not in self._migrant_pools]
+        if missing:
+            raise RuntimeError('No such islands {}'.format(', '.join(missing)))
+        pop = self.popMigrantArrays if arrays else self.popMigrants
+        return OrderedDict((str(id), pop(id, n)) for id in island_ids)
+
+    def garbageCollect(self, max_evictions=0):
+        # type: (int) -> int
         '''
         Purges migrant pools that are past their expiration time.
+        Only looks at heap entries that are due, so the cost is
+        proportional to the number of expired pools rather than
+        the total number of pools. Pools whose expiration was
+        extended since they were scheduled are rescheduled.
+
+        :param max_evictions: If positive, evict at most this many pools (the rest are left for the next call).
+        :return: The number of evicted pools.
+        '''
+        now = arrow.utcnow()
+        t_now = now.float_timestamp
+        n_evicted = 0
+        while self._expirations and self._expirations[0][0] < t_now:
+            if max_evictions > 0 and n_evicted >= max_evictions:
+                break
+            t,id = heappop(self._expirations)
+            if self._scheduled_expirations.get(id) != t:
+                # superseded by an earlier entry
+                continue
+            del self._scheduled_expirations[id]
+            pool = self._migrant_pools.get(id)
+            if pool is None:
+                continue
+            if now <= pool.expiration_time:
+                self.scheduleExpiration(id, pool.expiration_time)
+                continue
+            del self._migrant_pools[id]
+            # pending requests will fail on the missing pool
+            self.wakeWaiters(id)
+            n_evicted += 1
+        self.evicted += n_evicted
+        if n_evicted:
+            logger.info('Evicted {} expired migrant pools'.format(n_evicted))
+        return n_evicted
+
+    def stats(self):
+        # type: () -> typing.Dict[str,int]
+        '''
+        Number of live pools, migrants held and pools evicted so far.
         '''
-        time_now = arrow.utcnow()
-        self._migrant_pools = {(id,p) for id,p in self._migrant_pools.items() if time_now <= p.expiration_time}
+        return {
+          'pools': len(self._migrant_pools),
+          'migrants': sum(len(pool) for pool in self._migrant_pools.values()),
+          'evicted': self.evicted,
+          }
 
 # ** Request Handlers **
-class PurgeAllHandler(RequestHandler):
+def has_binary_body(request):
+    return request.headers.get('Content-Type', '').startswith(MIGRANTS_CONTENT_TYPE)
+
+def accepts_binary(request):
+    return MIGRANTS_CONTENT_TYPE in request.headers.get('Accept', '')
+
+def migrants_to_frame(migrants, meta=None):
+    '''
+    Converts popped migrants (see popMigrantArrays) to a
+    frame for encode_migrants.
+    '''
+    vectors,fitness,src_ids = migrants
+    return (vectors, fitness, dict(meta or {}, src_island_id=[str(src_id) for src_id in src_ids]))
+
+def migrants_to_json(migrants):
+    vectors,fitness,src_ids = migrants
+    return {
+      'migrants': vectors.tolist(),
+      'fitness': fitness.tolist(),
+      'src_island_id': [str(src_id) for src_id in src_ids],
+      }
+
+class MigrationHandler(RequestHandler):
+    '''
+    Base class for the migration service handlers.
+    '''
     def initialize(self, migration_host):
         self.migration_host = migration_host
 
-    def post(self):
+    def reportError(self, message):
+        logger.error(message)
+        self.clear()
+        self.set_status(400)
+        self.write({
+          'error': message,
+          })
+
+class PurgeAllHandler(MigrationHandler):
+    async def post(self):
         try:
             self.migration_host.purgeAll()
         except Exception as e:
-            print('Misc. error "{}"'.format(e))
-            self.clear()
-            self.set_status(400)
-            self.write({
-              'error': str(e),
-              })
-
-class DefineMigrantPoolHandler(RequestHandler):
-    def initialize(self, migration_host):
-        self.migration_host = migration_host
+            self.reportError('Misc. error "{}"'.format(e))
 
-    def post(self, id):
-        args = json_decode(self.request.body)
+class DefineMigrantPoolHandler(MigrationHandler):
+    async def post(self, id):
         try:
+            args = json_decode(self.request.body)
             self.migration_host.defineMigrantPool(id, **args)
-        except InvalidMigrantBufferType:
-            print('Invalid migrant buffer type "{}"'.format(args['buffer_type']))
-            self.clear()
-            self.set_status(400)
-            self.finish('No such migrant buffer type "{}"'.format(args['buffer_type']))
+        except InvalidMigrantBufferType as e:
+            self.reportError('No such migrant buffer type "{}"'.format(e.args[0]))
         except Exception as e:
-            print('Misc. error "{}"'.format(e))
-            self.clear()
-            self.set_status(400)
-            self.write({
-              'error': str(e),
-              })
-
-class PushMigrantHandler(RequestHandler):
-    def initialize(self, migration_host):
-        self.migration_host = migration_host
+            self.reportError('Misc. error "{}"'.format(e))
 
-    def post(self, id):
-        args = json_decode(self.request.body)
+class PushMigrantHandler(MigrationHandler):
+    async def post(self, id):
         try:
-            self.migration_host.pushMigrant(id, **args)
+            if has_binary_body(self.request):
+                for migrants,fitness,meta in decode_migrant_frames(self.request.body):
+                    for migrant_vector,f in zip(migrants,fitness):
+                        self.migration_host.pushMigrant(id, migrant_vector, float(f), **meta)
+            else:
+                self.migration_host.pushMigrant(id, **json_decode(self.request.body))
         except Exception as e:
-            print('Misc. error "{}"'.format(e))
-            self.clear()
-            self.set_status(400)
-            self.write({
-              'error': str(e),
-              })
-
-class PopMigrantsHandler(RequestHandler):
-    def initialize(self, migration_host):
-        self.migration_host = migration_host
+            self.reportError('Misc. error "{}"'.format(e))
 
-    def post(self, id):
-        args = json_decode(self.request.body)
+class PushMigrantsHandler(MigrationHandler):
+    async def post(self):
         try:
-            migrants = self.migration_host.popMigrants(id, **args)
-            self.write({
-              'migrants': [v.tolist() for v,fitness,src_id in migrants],
-              'fitness': [float(fitness) for v,fitness,src_id in migrants],
-              'src_island_id': [str(src_id) for v,fitness,src_id in migrants],
-              })
+            if has_binary_body(self.request):
+                pushes = [{
+                    'dest_island_id': meta['dest_island_id'],
+                    'src_island_id': meta.get('src_island_id'),
+                    'expiration_time': meta.get('expiration_time'),
+                    'migrants': migrants,
+                    'fitness': fitness,
+                  } for migrants,fitness,meta in decode_migrant_frames(self.request.body)]
+                self.migration_host.pushMigrants(pushes)
+            else:
+                self.migration_host.pushMigrants(**json_decode(self.request.body))
         except Exception as e:
-            print('Misc. error "{}"'.format(e))
-            self.clear()
-            self.set_status(400)
-            self.write({
-              'error': str(e),
-              })
+            self.reportError('Misc. error "{}"'.format(e))
+
+class PopMigrantsHandler(MigrationHandler):
+    async def post(self, id):
+        try:
+            args = json_decode(self.request.body)
+            min_count = args.pop('min_count', 0)
+            timeout = args.pop('timeout', 0.)
+            if min_count > 0 and timeout > 0.:
+                # long poll
+                await self.migration_host.waitForMigrants(id, min_count, timeout)
+            migrants = self.migration_host.popMigrantArrays(id, **args)
+            if accepts_binary(self.request):
+                self.set_header('Content-Type', MIGRANTS_CONTENT_TYPE)
+                self.write(encode_migrants(*migrants_to_frame(migrants)))
+            else:
+                self.write(migrants_to_json(migrants))
+        except Exception as e:
+            self.reportError('Misc. error "{}"'.format(e))
+
+class StatsHandler(MigrationHandler):
+    '''
+    Reports the number of live and evicted pools.
+    '''
+    async def get(self):
+        try:
+            self.write(dict(self.migration_host.stats(), shard_index=self.migration_host.shard_index))
+        except Exception as e:
+            self.reportError('Misc. error "{}"'.format(e))
+
+class PopMigrantsBulkHandler(MigrationHandler):
+    '''
+    Pops migrants for several islands in one request.
+    '''
+    async def post(self):
+        try:
+            args = json_decode(self.request.body)
+            islands = self.migration_host.popMigrantsBulk(args['island_ids'], args.get('n', 0), arrays=True)
+            if accepts_binary(self.request):
+                self.set_header('Content-Type', MIGRANTS_CONTENT_TYPE)
+                self.write(encode_migrant_frames(
+                    migrants_to_frame(migrants, {'island_id': id})
+                    for id,migrants in islands.items()))
+            else:
+                self.write({
+                  'islands': dict((id,migrants_to_json(migrants)) for id,migrants in islands.items()),
+                  })
+        except Exception as e:
+            self.reportError('Misc. error "{}"'.format(e))
 
 # TODO: test with https://github.com/eugeniy/pytest-tornado
-def create_central_migration_service():
-    migration_host = MigrationServiceHost()
+def create_central_migration_service(shard_index=0, n_shards=1, migration_host=None):
+    if migration_host is None:
+        migration_host = MigrationServiceHost(shard_index=shard_index, n_shards=n_shards)
     return Application([
         (r"/purge-all/?", PurgeAllHandler, {'migration_host': migration_host}),
+        (r"/stats/?", StatsHandler, {'migration_host': migration_host}),
         (r"/define-island/([a-z0-9-]+)/?", DefineMigrantPoolHandler, {'migration_host': migration_host}),
+        (r"/push-migrants/?", PushMigrantsHandler, {'migration_host': migration_host}),
+        (r"/pop-migrants/?", PopMigrantsBulkHandler, {'migration_host': migration_host}),
         (r"/([a-z0-9-]+)/push-migrant/?", PushMigrantHandler, {'migration_host': migration_host}),
         (r"/([a-z0-9-]+)/pop-migrants/?", PopMigrantsHandler, {'migration_host': migration_host}),
     ])
 
-def start_migration_service():
+def run_migration_service(port=10100, processes=1, on_start=None, gc_interval=10., gc_batch_size=100):
+    # type: (int, int, typing.Optional[typing.Callable[[int],None]], float, int) -> None
+    '''
+    Runs the migration service until interrupted. With processes > 1,
+    forks one worker per shard: worker k serves only the islands
+    with island_shard(id, processes) == k on port+k (clients
+    select the port, see CentralMigrator). Sockets are bound with
+    SO_REUSEPORT so a restarted worker can rebind its port at once.
+
+    :param on_start: Called with the shard index in each worker before the IOLoop starts.
+    :param gc_interval: Seconds between garbage collection passes over expired pools.
+    :param gc_batch_size: Maximum number of pools evicted per pass, so a pass never stalls request handling.
+    '''
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop, PeriodicCallback
+    from tornado.netutil import bind_sockets
+    from tornado.process import fork_processes
+    shard_index = fork_processes(processes) if processes > 1 else 0
+    migration_host = MigrationServiceHost(shard_index=shard_index, n_shards=processes)
+    server = HTTPServer(create_central_migration_service(migration_host=migration_host))
+    server.add_sockets(bind_sockets(port+shard_index, reuse_port=processes > 1))
+    logger.info('Migration service shard {} of {} listening on port {}'.format(shard_index, processes, port+shard_index))
+    if gc_interval > 0.:
+        PeriodicCallback(lambda: migration_host.garbageCollect(gc_batch_size), gc_interval*1000.).start()
+    if processes > 1:
+        # workers are not stopped with the parent process, so watch for it
+        import os
+        parent_pid = os.getppid()
+        def check_parent():
+            if os.getppid() != parent_pid:
+                IOLoop.current().stop()
+        PeriodicCallback(check_parent, 1000).start()
+    if on_start is not None:
+        on_start(shard_index)
+    try:
+        IOLoop.current().start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+def start_migration_service(port=10100, processes=1, gc_interval=10.):
     '''
     Starts the migration service in a separate process.
+    See run_migration_service for the arguments.
     '''
     from subprocess import Popen
     from os.path import join, dirname
     import sys
-    return Popen((sys.executable, join(dirname(__file__),'scripts','migration','migration_service.py'),))
\ No newline at end of file
+    return Popen((sys.executable, join(dirname(__file__),'scripts','migration','migration_service.py'),
+                  '--port', str(port), '--processes', str(processes), '--gc-interval', str(gc_interval)))
\ No newline at end of file
@@ -0,0 +1,134 @@
+# Sabaody
+# Copyright 2018 J Kyle Medley
+from __future__ import print_function, division, absolute_import
+
+from roadrunner import RoadRunner
+import roadrunner
+
+from numpy import array, asarray, int32
+from hashlib import sha256
+from threading import Lock
+import os
+import typing
+
+def read_sbml(sbml):
+    # type: (str) -> str
+    '''
+    Returns the SBML content. The argument can either be a path
+    to an SBML file or the SBML itself.
+    '''
+    if os.path.isfile(sbml):
+        with open(sbml) as f:
+            return f.read()
+    return sbml
+
+def sbml_hash(sbml_content):
+    # type: (str) -> str
+    '''
+    Content hash of an SBML model. Includes the RoadRunner version
+    since the serialized state is not portable across versions.
+    '''
+    h = sha256(roadrunner.__version__.encode('utf8'))
+    h.update(sbml_content.encode('utf8'))
+    return h.hexdigest()
+
+class ModelCache:
+    '''
+    Process-wide cache of compiled RoadRunner models, keyed by
+    a content hash of the SBML. Stores the serialized state of
+    each compiled model and hands out fresh instances loaded
+    from it, so the SBML is parsed and compiled at most once
+    per process. If cache_dir is set, the serialized state is
+    also stored on disk so other processes on the same host
+    can skip compilation entirely.
+    '''
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._states = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _statePath(self, key):
+        return os.path.join(self.cache_dir, key+'.rrstate')
+
+    def _compile(self, key, sbml_content):
+        # type: (str, str) -> bytes
+        '''
+        Get the serialized state from disk if possible,
+        otherwise compile the model.
+        '''
+        if self.cache_dir is not None and os.path.isfile(self._statePath(key)):
+            with open(self._statePath(key), 'rb') as f:
+                return f.read()
+        state = RoadRunner(sbml_content).saveStateS()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temp file first so concurrent readers never see a partial state
+            tmp_path = '{}.{}.tmp'.format(self._statePath(key), os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(state)
+            os.replace(tmp_path, self._statePath(key))
+        return state
+
+    def getModel(self, sbml):
+        # type: (str) -> RoadRunner
+        '''
+        Returns a new RoadRunner instance for the given SBML
+        (either a path or the SBML content) in its initial state.
+        '''
+        sbml_content = read_sbml(sbml)
+        key = sbml_hash(sbml_content)
+        with self._lock:
+            if key in self._states:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._states[key] = self._compile(key, sbml_content)
+            state = self._states[key]
+        r = RoadRunner()
+        r.loadStateS(state)
+        return r
+
+    def clear(self):
+        '''
+        Clears the in-memory cache (does not touch the disk cache).
+        '''
+        with self._lock:
+            self._states = {}
+            self.hits = 0
+            self.misses = 0
+
+# the disk cache can be enabled on Spark executors through the environment
+model_cache = ModelCache(cache_dir=os.environ.get('SABAODY_MODEL_CACHE_DIR'))
+
+def get_model(sbml):
+    # type: (str) -> RoadRunner
+    '''
+    Returns a fresh RoadRunner instance from the process-wide model cache.
+    '''
+    return model_cache.getModel(sbml)
+
+def global_parameter_indices(r, param_list):
+    # type: (RoadRunner, typing.Sequence[str]) -> typing.Optional[array]
+    '''
+    Resolves a list of parameter ids to indices into the model's
+    global parameter array. Returns None if any of the ids is
+    not a global parameter (e.g. a species or compartment).
+    '''
+    index_of = dict((id,k) for k,id in enumerate(r.model.getGlobalParameterIds()))
+    if not all(p in index_of for p in param_list):
+        return None
+    return array([index_of[p] for p in param_list], dtype=int32)
+
+def set_parameter_values(r, param_list, indices, x):
+    # type: (RoadRunner, typing.Sequence[str], typing.Optional[array], array) -> None
+    '''
+    Applies the parameter values x in a single bulk call if the
+    indices could be resolved, otherwise one at a time.
+    '''
+    if indices is not None:
+        r.model.setGlobalParameterValues(indices, asarray(x, dtype=float))
+    else:
+        for i,v in enumerate(x):
+            r[param_list[i]] = v
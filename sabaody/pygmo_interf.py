@@ -5,10 +5,12 @@ from __future__ import print_function, division, absolute_import
 from .utils import check_vector, expect
 
 from abc import ABC, abstractmethod
-from numpy import array
+from numpy import array, atleast_2d, asarray, frexp, rint, empty
 from typing import SupportsFloat
+import typing
 from uuid import uuid4
 from json import dumps, loads
+from collections import OrderedDict
 
 class Evaluator(ABC):
     '''
@@ -22,6 +24,157 @@ class Evaluator(ABC):
         '''Evaluates the objective function.'''
         pass
 
+    def evaluateBatch(self, X):
+        # type: (array) -> array
+        '''
+        Evaluates the objective function for every row of the
+        (n, d) decision matrix X and returns the n fitness values.
+        '''
+        return array([self.evaluate(x) for x in atleast_2d(X)])
+
+class MemoizedEvaluator(Evaluator):
+    '''
+    Wraps an evaluator with a bounded LRU cache of fitness values.
+    Decision vectors are quantized to a given number of significant
+    digits before hashing, so vectors that differ only by round-off
+    (e.g. after a round trip through the migration service) share
+    an entry. Penalty scores are not cached, since a failed or
+    timed-out simulation may succeed on another attempt.
+    '''
+    def __init__(self, evaluator, maxsize=1024, digits=12, penalty=None, batch_evaluator=None):
+        # type: (Evaluator, int, int, typing.Optional[float], typing.Any) -> None
+        '''
+        Constructor.
+
+        :param penalty: Results equal to this value are not cached. Defaults to the penalty attribute of the evaluator, if any.
+        :param batch_evaluator: Evaluates the cache misses of a batch (e.g. a BatchEvaluator). Defaults to evaluator.
+        '''
+        expect(maxsize > 0, 'Cache size must be positive')
+        self.evaluator = evaluator
+        self.batch_evaluator = batch_evaluator if batch_evaluator is not None else evaluator
+        self.penalty = penalty if penalty is not None else getattr(evaluator, 'penalty', None)
+        self.maxsize = maxsize
+        self.digits = digits
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, x):
+        # type: (array) -> bytes
+        '''
+        Quantized hash key for the decision vector x.
+        '''
+        mantissa,exponent = frexp(asarray(x, dtype=float))
+        return rint(mantissa*10**self.digits).tobytes() + exponent.tobytes()
+
+    def evaluate(self, x):
+        # type: (array) -> SupportsFloat
+        k = self.key(x)
+        if k in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(k)
+            return self._cache[k]
+        self.misses += 1
+        f = self.evaluator.evaluate(x)
+        self.store(k, f)
+        return f
+
+    def store(self, k, f):
+        # type: (bytes, SupportsFloat) -> None
+        if self.penalty is not None and f == self.penalty:
+            return
+        self._cache[k] = f
+        if len(self._cache) > self.maxsize:
+            # evict least recently used
+            self._cache.popitem(last=False)
+
+    def evaluateBatch(self, X):
+        # type: (array) -> array
+        '''
+        Looks up every row of X in the cache and evaluates the
+        misses (each distinct vector once) in a single call to
+        the batch evaluator.
+        '''
+        X = atleast_2d(X)
+        f = empty(X.shape[0])
+        # rows of X for each missing key
+        missing = OrderedDict()
+        for i,x in enumerate(X):
+            k = self.key(x)
+            if k in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(k)
+                f[i] = self._cache[k]
+            elif k in missing:
+                self.hits += 1
+                missing[k].append(i)
+            else:
+                self.misses += 1
+                missing[k] = [i]
+        if missing:
+            rows = [indices[0] for indices in missing.values()]
+            for (k,indices),y in zip(missing.items(), self.batch_evaluator.evaluateBatch(X[rows])):
+                f[indices] = y
+                self.store(k, y)
+        return f
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+# evaluator owned by the current batch worker process
+_batch_worker_evaluator = None
+
+def _init_batch_worker(evaluator_constructor):
+    global _batch_worker_evaluator
+    _batch_worker_evaluator = evaluator_constructor()
+
+def _evaluate_in_batch_worker(x):
+    return float(_batch_worker_evaluator.evaluate(x))
+
+class BatchEvaluator:
+    '''
+    Evaluates the rows of a decision matrix in parallel using a
+    pool of worker processes. Each worker constructs its own
+    evaluator once (via evaluator_constructor, which must be
+    picklable) and reuses it for all subsequent evaluations.
+    The pool is started lazily on the first batch.
+    '''
+    def __init__(self, evaluator_constructor, processes=None):
+        from multiprocessing import cpu_count
+        self.evaluator_constructor = evaluator_constructor
+        self.processes = processes or cpu_count()
+        self._pool = None
+
+    def evaluateBatch(self, X):
+        # type: (array) -> array
+        X = atleast_2d(X)
+        if self._pool is None:
+            from multiprocessing import Pool
+            self._pool = Pool(self.processes, initializer=_init_batch_worker, initargs=(self.evaluator_constructor,))
+            import atexit
+            atexit.register(self.close)
+        chunksize = max(1, X.shape[0]//self.processes)
+        return array(self._pool.map(_evaluate_in_batch_worker, X, chunksize=chunksize))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __getstate__(self):
+        # worker processes are not transferred, they are restarted on demand
+        return {
+          'evaluator_constructor': self.evaluator_constructor,
+          'processes': self.processes}
+
+    def __setstate__(self, state):
+        self.evaluator_constructor = state['evaluator_constructor']
+        self.processes = state['processes']
+        self._pool = None
+
 
 class Island:
     def __init__(self, id, problem_constructor, algorithm_constructor, size, domain_qualifier, mc_host, mc_port=11211):
@@ -33,14 +186,20 @@ class Island:
         self.size = size
         self.domain_qualifier = domain_qualifier
 
-def run_island(island, topology):
+def run_island(island, topology, migrator=None, asynchronous=False):
+    '''
+    Evolves an island and migrates after every round. If asynchronous
+    is true, migrants are sent in the background while the island
+    evolves, and incoming migrants are applied as they arrive.
+    '''
     import pygmo as pg
     from multiprocessing import cpu_count
     from pymemcache.client.base import Client
-    from sabaody.migration import BestSPolicy, FairRPolicy
+    from sabaody.migration import BestSPolicy, FairRPolicy, BackgroundMigrator, PopulationSnapshot
     from sabaody.migration_central import CentralMigrator
     mc_client = Client((island.mc_host,island.mc_port))
-    migrator = CentralMigrator('http://luna:10100')
+    if migrator is None:
+        migrator = CentralMigrator('http://luna:10100', BestSPolicy(migration_rate=1), FairRPolicy())
 
     algorithm = pg.de(gen=10)
     problem = island.problem_constructor()
@@ -52,13 +211,24 @@ def run_island(island, topology):
 
     rounds = 10
     migration_log = []
+    if asynchronous:
+        background_migrator = BackgroundMigrator(migrator, island.id, topology)
     for x in range(rounds):
         i.evolve()
         i.wait()
 
         # perform migration
-        migrator.sendMigrants(island.id, i, topology)
-        deltas,src_ids = migrator.receiveMigrants(island.id, i, topology)
+        if asynchronous:
+            pop = i.get_population()
+            snapshot = PopulationSnapshot(pop)
+            background_migrator.sendMigrants(snapshot)
+            # apply whatever arrived during evolution
+            deltas,src_ids = background_migrator.receiveMigrants(snapshot)
+            if deltas:
+                i.set_population(pop)
+        else:
+            deltas,src_ids = migrator.migrate(island.id, i, topology)
+            pop = i.get_population()
 
         """
         For Kafka Migration Enable below 
@@ -67,6 +237,8 @@ def run_island(island, topology):
         #deltas,src_ids = migrator.receive_migrants(island.id,i,topology,generation=x)
 
         migration_log.append((float(pop.champion_f[0]),deltas,src_ids))
+    if asynchronous:
+        background_migrator.close()
 
     import socket
     hostname = socket.gethostname()
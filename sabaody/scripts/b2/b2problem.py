@@ -13,7 +13,7 @@ class B2Problem(TimecourseModel):
     ''' Class that performs a timecourse simulation
     and calculates the residuals for b4.'''
 
-    def __init__(self, sbml):
+    def __init__(self, sbml, log_params=False, solver_config=None):
         super().__init__(sbml, data_quantities, {
           'cpep': PEP,
           'cg6p': G6P,
@@ -23,7 +23,7 @@ class B2Problem(TimecourseModel):
           'cg1p': G1P,
           'cpg': x6PG,
           'cfdp': FDP,
-        })
+        }, param_list, log_params=log_params, solver_config=solver_config)
 
     def setParameterVector(self, x):
         # type: (array) -> None
@@ -48,15 +48,20 @@ def problem_constructor2(n):
     import pygmo as pg
     return pg.rosenbrock(n)
 
-def make_problem():
+def make_problem(batch_processes=None, memo_size=None, log_params=False, surrogate_fraction=None):
     class B2_UDP:
-        def __init__(self, lb, ub):
-            # type: (Evaluator, array, array) -> None
+        def __init__(self, lb, ub, batch_processes=None, memo_size=None, log_params=False, surrogate_fraction=None):
+            # type: (Evaluator, array, array, int, int, bool, float) -> None
             '''
             Inits the problem with an objective evaluator
             (implementing the method evaluate), the parameter
             vector lower bound (a numpy array) and upper bound.
             Both bounds must have the same dimension.
+
+            :param batch_processes: If set, batch_fitness fans out to this many worker processes. Otherwise, batches are evaluated serially.
+            :param memo_size: If set, memoize up to this many fitness values (LRU).
+            :param log_params: If true, search in log10 space. The bounds lb and ub are still given in linear space.
+            :param surrogate_fraction: If set, pre-screen batches with a surrogate and only simulate this fraction of each batch.
             '''
             from sabaody.utils import check_vector, expect
             check_vector(lb)
@@ -64,14 +69,58 @@ def make_problem():
             expect(len(lb) == len(ub), 'Bounds mismatch')
             self.lb = lb
             self.ub = ub
+            self.batch_processes = batch_processes
+            self.memo_size = memo_size
+            self.log_params = log_params
+            self.surrogate_fraction = surrogate_fraction
+            self._makeEvaluators()
+
+        def _makeEvaluators(self):
             from b2problem import B2Problem
-            self.evaluator = B2Problem('b2.xml')
+            self.model = B2Problem('b2.xml', self.log_params)
+            self.evaluator = self.model
+            if self.batch_processes is not None:
+                from sabaody import BatchEvaluator
+                from toolz import partial
+                self.batch_evaluator = BatchEvaluator(partial(B2Problem, 'b2.xml', self.log_params), self.batch_processes)
+            else:
+                self.batch_evaluator = self.evaluator
+            if self.memo_size is not None:
+                # batches are looked up in the memo too, only misses go to the pool
+                from sabaody import MemoizedEvaluator
+                self.evaluator = MemoizedEvaluator(self.evaluator, self.memo_size, batch_evaluator=self.batch_evaluator)
+                self.batch_evaluator = self.evaluator
+            if self.surrogate_fraction is not None:
+                from sabaody.surrogate import SurrogateEvaluator
+                self.evaluator = SurrogateEvaluator(self.evaluator, self.surrogate_fraction, batch_evaluator=self.batch_evaluator)
+                self.batch_evaluator = self.evaluator
 
         def fitness(self, x):
             return (self.evaluator.evaluate(x),)
 
+        def batch_fitness(self, dvs):
+            '''
+            Evaluates a batch of decision vectors. pygmo passes
+            the vectors concatenated into a single flat array.
+            '''
+            return self.batch_evaluator.evaluateBatch(dvs.reshape(-1, len(self.lb)))
+
+        def gradient(self, x):
+            '''
+            Gradient of the fitness, used by pygmo's gradient-based
+            local optimizers. RoadRunner's sensitivity solver does not
+            support B2, so this uses forward differences.
+            '''
+            return self.model.gradient(x, 'fd')
+
         def get_bounds(self):
-            return (self.lb,self.ub)
+            return (self.model.encodeParameters(self.lb),self.model.encodeParameters(self.ub))
+
+        def decode(self, x):
+            '''
+            Converts a decision vector (e.g. a champion) to parameter values.
+            '''
+            return self.model.decodeParameters(x)
 
         def get_name(self):
             return 'Sabaody udp'
@@ -82,13 +131,20 @@ def make_problem():
         def __getstate__(self):
             return {
               'lb': self.lb,
-              'ub': self.ub}
+              'ub': self.ub,
+              'batch_processes': self.batch_processes,
+              'memo_size': self.memo_size,
+              'log_params': self.log_params,
+              'surrogate_fraction': self.surrogate_fraction}
 
         def __setstate__(self, state):
             self.lb = state['lb']
             self.ub = state['ub']
-            from b2problem import B2Problem
-            self.evaluator = B2Problem('b2.xml')
+            self.batch_processes = state.get('batch_processes')
+            self.memo_size = state.get('memo_size')
+            self.log_params = state.get('log_params', False)
+            self.surrogate_fraction = state.get('surrogate_fraction')
+            self._makeEvaluators()
 
     import pygmo as pg
-    return pg.problem(B2_UDP(getLowerBound(),getUpperBound()))
\ No newline at end of file
+    return pg.problem(B2_UDP(getLowerBound(),getUpperBound(),batch_processes,memo_size,log_params,surrogate_fraction))
\ No newline at end of file
@@ -156,9 +156,9 @@ def applyParamVec(r, p):
     '''
     Applies a parameter vector p to a RoadRunner instance r.
     '''
-    expect(len(p) != len(param_list), 'Parameter vector size mismatch')
-    for k,v in enumerate(p):
-        r[param_list[k]] = v
+    from sabaody.model_cache import global_parameter_indices, set_parameter_values
+    expect(len(p) == len(param_list), 'Parameter vector size mismatch')
+    set_parameter_values(r, param_list, global_parameter_indices(r, param_list), p)
 
 
 def getDefaultParamValues():
@@ -2,7 +2,8 @@ from kafka import KafkaProducer
 from kafka import KafkaConsumer
 from uuid import uuid4
 from interruptingcow import timeout
-import json
+from numpy import array, vstack, concatenate
+from sabaody.migrant_codec import encode_migrants, decode_migrant_frames
 
 class KafkaBuilder(object):
     _hosts = "128.208.17.254"
@@ -41,18 +42,20 @@ class KafkaMigration(object):
     @staticmethod
     def migrate(migrants , from_island , to_island , num_generation):
         topic_name = "_".join([to_island , KafkaMigration._identifier , str(num_generation)])
-        KafkaMigration._producer.send(topic_name , key = from_island, value =KafkaMigration.serialize(each_migrant))
+        KafkaMigration._producer.send(topic_name , key = from_island, value =KafkaMigration.serialize(migrants))
 
 
     @staticmethod
     def serialize(migrants):
-        serialized_data = {"data":migrants}
-        return json.dumps(serialized_data)
+        # binary frame, see sabaody.migrant_codec
+        migrants = list(migrants)
+        return encode_migrants(array([m for m,f in migrants]), array([f for m,f in migrants]))
 
 
     @staticmethod
     def deserialize(migrant):
-        return json.loads(migrant)["data"]
+        migrants,fitness,meta = decode_migrant_frames(migrant)[0]
+        return (migrants, fitness)
 
 
 
@@ -65,14 +68,17 @@ class KafkaMigration(object):
         try:
             with timeout(KafkaMigration._timeout , exception=RuntimeError):
                 for each_migrant in consumer:
-                    source_ids.append((each_migrant.key))
-                    replacement_policy_migrants.append(KafkaMigration.deserialize(each_migrant.value))
+                    migrants,fitness = KafkaMigration.deserialize(each_migrant.value)
+                    source_ids.extend([each_migrant.key]*fitness.size)
+                    replacement_policy_migrants.append((migrants,fitness))
                     if len(replacement_policy_migrants) >= KafkaMigration._buffer_size:
                         break
                     elif len(replacement_policy_migrants) >= indegree:
                         break
         except RuntimeError:
-            print "Timeout for request from Island : {0} for generation : {1}".format(island,num_generation)
-        replacement_policy_migrants =  zip(*replacement_policy_migrants)
-        replacement_policy_migrants.append(source_ids)
-        return replacement_policy_migrants
+            print("Timeout for request from Island : {0} for generation : {1}".format(island,num_generation))
+        if not replacement_policy_migrants:
+            return (array([]), array([]).reshape(0,1), source_ids)
+        return (vstack([m for m,f in replacement_policy_migrants]),
+                concatenate([f for m,f in replacement_policy_migrants]).reshape(-1,1),
+                source_ids)
@@ -2,29 +2,22 @@
 # Copyright 2018 J Kyle Medley
 from __future__ import print_function, division, absolute_import
 
-from sabaody.migration_central import create_central_migration_service
+from sabaody.migration_central import run_migration_service
 
-import tornado.escape
-from tornado.web import Application
-from tornado.ioloop import IOLoop
-from tornado.escape import json_decode
-from apscheduler.schedulers.tornado import TornadoScheduler
-
-import atexit
-from datetime import date
-
-# https://stackoverflow.com/questions/21214270/scheduling-a-function-to-run-every-hour-on-flask
-# garbage collection scheduler
-def garbage_collect():
-    print('le gc')
+import argparse
+import logging
 
 if __name__ == "__main__":
-    gc_scheduler = TornadoScheduler()
-    gc_scheduler.add_job(garbage_collect, 'interval', seconds=3)
-    gc_scheduler.start()
+    parser = argparse.ArgumentParser(description='Run the central migration service.')
+    parser.add_argument('--port', type=int, default=10100,
+                        help='The port to listen on (the first port if using more than one process).')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='The number of worker processes. Islands are sharded across processes, process k listens on port+k.')
+    parser.add_argument('--gc-interval', type=float, default=10.,
+                        help='Seconds between garbage collection passes over expired migrant pools (0 to disable).')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # one line per request is too much at round boundaries
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
 
-    create_central_migration_service().listen(10100)
-    try:
-        IOLoop.instance().start()
-    except (KeyboardInterrupt, SystemExit):
-        pass
\ No newline at end of file
+    run_migration_service(args.port, args.processes, gc_interval=args.gc_interval)
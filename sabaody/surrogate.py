@@ -0,0 +1,161 @@
+# Sabaody
+# Copyright 2018 J Kyle Medley
+from __future__ import print_function, division, absolute_import
+
+from .pygmo_interf import Evaluator
+from .utils import expect
+
+from numpy import array, asarray, atleast_2d, ones, zeros, full, hstack, vstack, argpartition, isfinite, sqrt, maximum
+from numpy.linalg import lstsq
+from math import ceil
+import typing
+
+class RBFSurrogate:
+    '''
+    Cubic radial basis function interpolant with a linear tail,
+    fit on inputs scaled to the unit box of the training data.
+    '''
+    def __init__(self, regularization=1e-8):
+        self.regularization = regularization
+        self.centers = None
+
+    def _scale(self, X):
+        return (X - self.lo)/self.width
+
+    def _kernel(self, X):
+        # pairwise distances between the rows of X and the centers
+        d2 = ((X[:,None,:] - self.centers[None,:,:])**2).sum(axis=2)
+        return sqrt(d2)**3
+
+    def fit(self, X, f):
+        # type: (array, array) -> None
+        X = atleast_2d(X)
+        n,d = X.shape
+        self.lo = X.min(axis=0)
+        self.width = maximum(X.max(axis=0) - self.lo, 1e-12)
+        self.centers = self._scale(X)
+        P = hstack((ones((n,1)), self.centers))
+        A = zeros((n+d+1, n+d+1))
+        A[:n,:n] = self._kernel(self.centers)
+        A[range(n),range(n)] += self.regularization
+        A[:n,n:] = P
+        A[n:,:n] = P.T
+        b = hstack((f, zeros(d+1)))
+        coeffs = lstsq(A, b, rcond=None)[0]
+        self.weights = coeffs[:n]
+        self.tail = coeffs[n:]
+
+    def predict(self, X):
+        # type: (array) -> array
+        Z = self._scale(atleast_2d(X))
+        return self._kernel(Z).dot(self.weights) + self.tail[0] + Z.dot(self.tail[1:])
+
+class SurrogateEvaluator(Evaluator):
+    '''
+    Pre-screens batches of candidates with a cheap surrogate trained
+    online on the exactly evaluated (x, f) pairs. Only the most
+    promising fraction of each batch (lowest predicted fitness) is
+    simulated. The rest are assigned the penalty score rather than
+    their prediction, so an unverified candidate can never replace
+    an individual in the population (or become a migrant or the
+    champion). Single evaluations are always exact. The surrogate is only used
+    once it has seen min_samples points and while its prediction error
+    on the last exact evaluations stays within trust (RMS error divided
+    by the standard deviation of the exact values).
+    '''
+    def __init__(self, evaluator, fraction=0.25, trust=0.5, min_samples=20, retrain_interval=10, max_samples=500, batch_evaluator=None, surrogate=None, penalty=None):
+        # type: (Evaluator, float, float, int, int, int, typing.Any, typing.Optional[RBFSurrogate], typing.Optional[float]) -> None
+        '''
+        Constructor.
+
+        :param fraction: Fraction of each batch to evaluate exactly.
+        :param trust: Maximum relative prediction error at which the surrogate is still used.
+        :param min_samples: Number of exact evaluations before the surrogate is first trained.
+        :param retrain_interval: Number of new exact evaluations between refits.
+        :param max_samples: Train on at most this many (most recent) samples.
+        :param batch_evaluator: Used for the exact part of a batch (e.g. a BatchEvaluator). Defaults to evaluator.
+        :param penalty: Fitness of the candidates that are not simulated. Defaults to the penalty attribute of the evaluator, or the worst value in the batch if there is none.
+        '''
+        expect(0. < fraction <= 1., 'Fraction must be in (0,1]')
+        expect(min_samples > 1, 'Need at least two samples to train')
+        self.evaluator = evaluator
+        self.batch_evaluator = batch_evaluator if batch_evaluator is not None else evaluator
+        self.fraction = fraction
+        self.trust = trust
+        self.min_samples = min_samples
+        self.retrain_interval = retrain_interval
+        self.max_samples = max_samples
+        self.surrogate = surrogate if surrogate is not None else RBFSurrogate()
+        self.penalty = penalty if penalty is not None else getattr(evaluator, 'penalty', None)
+        self.X = []
+        self.f = []
+        # exact samples recorded since the last fit
+        self.new_samples = 0
+        self.trained = False
+        self.error = None
+        # number of simulations replaced by surrogate predictions
+        self.saved_evaluations = 0
+
+    def record(self, X, f):
+        # type: (array, array) -> None
+        '''
+        Adds exactly evaluated points to the training set and
+        refits the surrogate when due. Failed simulations
+        (non-finite fitness) are not used for training.
+        '''
+        for x,y in zip(X, f):
+            if isfinite(y):
+                self.X.append(array(x, dtype=float))
+                self.f.append(float(y))
+                self.new_samples += 1
+        # the training set is capped, so count new samples rather than comparing sizes
+        del self.X[:-self.max_samples]
+        del self.f[:-self.max_samples]
+        if len(self.f) >= self.min_samples and (not self.trained or self.new_samples >= self.retrain_interval):
+            self.surrogate.fit(vstack(self.X), array(self.f))
+            self.new_samples = 0
+            self.trained = True
+
+    def isTrusted(self):
+        return self.trained and (self.error is None or self.error <= self.trust)
+
+    def validate(self, predicted, f):
+        # type: (array, array) -> None
+        '''
+        Updates the prediction error from a set of exact evaluations.
+        '''
+        spread = f.std()
+        if len(f) > 1 and spread > 0.:
+            self.error = float(sqrt(((predicted - f)**2).mean())/spread)
+
+    def evaluate(self, x):
+        # type: (array) -> float
+        f = float(self.evaluator.evaluate(x))
+        self.record([x], [f])
+        return f
+
+    def evaluateBatch(self, X):
+        # type: (array) -> array
+        X = atleast_2d(X)
+        n = X.shape[0]
+        if not self.isTrusted():
+            f = asarray(self.batch_evaluator.evaluateBatch(X), dtype=float)
+            if self.trained:
+                self.validate(self.surrogate.predict(X), f)
+            self.record(X, f)
+            return f
+        predicted = self.surrogate.predict(X)
+        n_exact = min(n, int(ceil(self.fraction*n)))
+        best = argpartition(predicted, n_exact-1)[:n_exact]
+        exact = asarray(self.batch_evaluator.evaluateBatch(X[best]), dtype=float)
+        # predictions never enter the population
+        if self.penalty is not None:
+            screened_out = self.penalty
+        else:
+            screened_out = max(exact.max(), predicted.max())
+        f = full(n, screened_out)
+        f[best] = exact
+        self.validate(predicted[best], exact)
+        self.record(X[best], exact)
+        self.saved_evaluations += n - n_exact
+        return f
@@ -1,83 +1,317 @@
 from __future__ import print_function, division, absolute_import
 
 from collections import OrderedDict
-from numpy import array, hstack, argwhere, unique, maximum, minimum
+from numpy import array, asarray, log10, log, power, linspace, rint, empty, hstack, unique, maximum, minimum, zeros, searchsorted, flatnonzero, take, subtract, dot, cumsum, argmin, sqrt
 from typing import SupportsFloat
+import typing
 from builtins import super
+from time import monotonic
+from fractions import Fraction
+from functools import reduce
+from math import gcd
 import os
+import attr
 
 import tellurium as te # used to patch roadrunner
 from roadrunner import RoadRunner
 from sabaody.utils import expect
 
 from .pygmo_interf import Evaluator
+from .model_cache import get_model, global_parameter_indices, set_parameter_values
 
 #raise RuntimeError('improt tc')
 
-class MissingValue(Exception):
+class SimulationTimeout(RuntimeError):
     pass
 
-def valueAtTime(a,t):
-    ''' Find a value in a matching the measurement time t. '''
-    try:
-        return float(a[argwhere(a[:,0] == t)[0],1])
-    except IndexError:
-        raise MissingValue
-    except TypeError:
-        print(argwhere(a[:,0] == t))
-        raise MissingValue
+def common_time_step(times, max_denominator=10000):
+    # type: (array, int) -> float
+    '''
+    Returns the largest step h such that every time in times
+    is an integer multiple of h (up to rational approximation).
+    '''
+    fractions = [Fraction(float(t)).limit_denominator(max_denominator) for t in times if t != 0]
+    denominator = reduce(lambda a,b: a*b//gcd(a,b), (f.denominator for f in fractions), 1)
+    numerator = reduce(gcd, (int(f*denominator) for f in fractions), 0)
+    return numerator/denominator
+
+@attr.s
+class SolverConfig:
+    '''
+    Integrator settings for a TimecourseModel.
+    Settings left as None use the RoadRunner defaults.
+    '''
+    # name of the RoadRunner integrator, e.g. 'cvode' or 'rk45'
+    integrator = attr.ib(default='cvode')
+    # use BDF (stiff) or Adams (non-stiff) methods - CVODE only
+    stiff = attr.ib(default=None)
+    rtol = attr.ib(default=None)
+    atol = attr.ib(default=None)
+    # maximum number of internal steps per output interval - CVODE only
+    max_steps = attr.ib(default=None)
+    # wall-clock limit in seconds for one evaluation, checked between
+    # simulation segments (use max_steps to bound a single segment)
+    wall_clock_limit = attr.ib(default=None)
+    # score assigned when the simulation fails or times out
+    penalty = attr.ib(default=1e9)
+    # output step size and minimum number of steps for the stepwise mode
+    stepsize = attr.ib(default=0.1)
+    min_steps = attr.ib(default=100)
+
+    def apply(self, r):
+        # type: (RoadRunner) -> None
+        '''
+        Applies the integrator settings to a RoadRunner instance.
+        Settings not supported by the integrator are ignored.
+        '''
+        r.setIntegrator(self.integrator)
+        integrator = r.getIntegrator()
+        # start from the defaults so settings from a previous config do not leak
+        # (re-set each value explicitly, resetSettings alone does not reach the solver)
+        integrator.resetSettings()
+        supported = integrator.getSettings()
+        for name in supported:
+            integrator.setValue(name, integrator.getValue(name))
+        for name,value in (
+            ('stiff', self.stiff),
+            ('relative_tolerance', self.rtol),
+            ('absolute_tolerance', self.atol),
+            ('maximum_num_steps', self.max_steps)):
+            if value is not None and name in supported:
+                integrator.setValue(name, value)
+
+class SteadyStateCache:
+    '''
+    Bounded cache of steady states (floating species amounts) keyed
+    by parameter vector. Used to warm-start the steady state solver
+    from the nearest previously solved parameter vector. Distances
+    are relative to the magnitude of the query vector. When full,
+    the oldest entry is replaced.
+    '''
+    def __init__(self, maxsize=256, exact_rtol=0.):
+        # type: (int, float) -> None
+        expect(maxsize > 0, 'Cache size must be positive')
+        self.maxsize = maxsize
+        # treat entries within this relative distance as exact hits (no solve)
+        self.exact_rtol = exact_rtol
+        self.keys = None
+        self.states = None
+        self.size = 0
+        self.next_slot = 0
+        self.hits = 0
+        self.warm_starts = 0
+        self.cold_solves = 0
+
+    def nearest(self, p):
+        # type: (array) -> typing.Tuple[typing.Optional[array], float]
+        '''
+        Returns the cached state for the parameter vector nearest to p
+        and its relative distance, or (None, inf) if the cache is empty.
+        '''
+        if self.size == 0:
+            return (None, float('inf'))
+        scale = maximum(abs(p), 1e-12)
+        d = (((self.keys[:self.size] - p)/scale)**2).sum(axis=1)
+        k = int(argmin(d))
+        return (self.states[k], float(sqrt(d[k])))
+
+    def store(self, p, state):
+        # type: (array, array) -> None
+        if self.keys is None:
+            self.keys = empty((self.maxsize, len(p)))
+            self.states = empty((self.maxsize, len(state)))
+        self.keys[self.next_slot] = p
+        self.states[self.next_slot] = state
+        self.next_slot = (self.next_slot+1) % self.maxsize
+        self.size = min(self.size+1, self.maxsize)
+
+    def clear(self):
+        self.size = 0
+        self.next_slot = 0
+        self.hits = 0
+        self.warm_starts = 0
+        self.cold_solves = 0
 
 class TimecourseModel(Evaluator):
     ''' Class that performs a timecourse simulation
     and calculates the residuals for b4.'''
 
-    def __init__(self, sbml, data_quantities, measurement_map):
+    def __init__(self, sbml, data_quantities, measurement_map, param_list=None, single_pass=True, diagnostics=False, log_params=False, solver_config=None, initial_conditions=None, model=None, preequilibrate=False, steady_state_cache=None):
         '''
         Constructor.
 
         :param measurement_map: A dictionary that maps the names of quantities to measurements to their respective (numpy) arrays.
+        :param param_list: The ids of the parameters in the decision vector. If given, they are resolved to model indices once here.
+        :param single_pass: If true, integrate once over the whole timecourse and report output only at the measurement times. Otherwise, restart the integrator at every measurement time (legacy behavior).
+        :param diagnostics: If true, keep a history of the residuals for each quantity across evaluations (memory grows with the number of evaluations).
+        :param log_params: If true, decision vectors passed to evaluate are the log10 of the model parameters.
+        :param solver_config: A SolverConfig with the integrator settings. If None, use the defaults.
+        :param initial_conditions: A dictionary of initial values applied after every reset, e.g. for a perturbation experiment.
+        :param model: A RoadRunner instance for sbml to use instead of creating a new one. Can be shared by several TimecourseModels (see ExperimentSet).
+        :param preequilibrate: If true, bring the model to steady state for each parameter vector before the timecourse starts (initial_conditions are applied afterwards). Steady states are cached in self.steady_state_cache.
+        :param steady_state_cache: A SteadyStateCache to use for pre-equilibration (implies preequilibrate). Can be shared by TimecourseModels on the same model, since the steady state does not depend on initial_conditions.
         '''
         self.sbml = sbml
-        self.r = RoadRunner(sbml)
-        self.residuals = []
+        # compiled once per process, see model_cache
+        self.r = model if model is not None else get_model(sbml)
+        self.initial_conditions = initial_conditions or {}
+        if steady_state_cache is not None:
+            self.steady_state_cache = steady_state_cache
+        else:
+            self.steady_state_cache = SteadyStateCache() if preequilibrate else None
+        self.setSolverConfig(solver_config or SolverConfig())
+        self.diagnostics = diagnostics
+        self.log_params = log_params
+        self.param_list = param_list
+        self.param_indices = global_parameter_indices(self.r, param_list) if param_list is not None else None
         #print(self.r.getFloatingSpeciesIds())
 
-        self.timepoints = unique(hstack(a[:,0] for a in data_quantities))
+        self.timepoints = unique(hstack([a[:,0] for a in data_quantities]))
         self.reset()
 
         self.measurement_map = measurement_map
+        self.single_pass = single_pass
+        # output times for the single pass simulation - must start at zero
+        if self.timepoints[0] > 0:
+            self.output_times = hstack(([0.], self.timepoints))
+        else:
+            self.output_times = self.timepoints
+        # only report the measured quantities
+        self.quantities = list(self.measurement_map.keys())
+        self.selections = ['time'] + self.quantities
+        self.buildMeasurementIndex()
 
+        # preallocated residual buffer, overwritten on every evaluation
+        self.residuals = zeros(self.n_residuals)
+        self.residual_count = 0
+        self._delta = zeros(self.measurement_mask.shape)
         # keep track of the number of times a measurement is used
         # (check correct number of residuals)
-        self.measurement_count = OrderedDict((quantity,0) for quantity in self.measurement_map)
+        self.measurement_count = zeros(len(self.quantities), dtype=int)
+        # number of simulation segments when evaluating with an upper bound
+        # (the bound is checked after each segment)
+        self.abort_segments = 4
+        self.aborted_evaluations = 0
+        # number of evaluations that used the penalty score
+        self.penalty_evaluations = 0
+        self.timeout_evaluations = 0
+        self.deadline = None
+        # per-quantity residual history, only used in diagnostics mode
         self.quantity_residuals = dict((quantity,list()) for quantity in self.measurement_map)
 
+    def buildMeasurementIndex(self):
+        '''
+        Builds a dense timepoint-by-quantity index of the measurements.
+        self.measurement_mask is true wherever a measurement exists and
+        self.measurement_values holds the aligned measured values
+        (zero where there is no measurement).
+        '''
+        shape = (len(self.timepoints), len(self.quantities))
+        self.measurement_mask = zeros(shape, dtype=bool)
+        self.measurement_values = zeros(shape)
+        for j,quantity in enumerate(self.quantities):
+            a = self.measurement_map[quantity]
+            rows = searchsorted(self.timepoints, a[:,0])
+            expect((self.timepoints[rows] == a[:,0]).all(), 'Measurement times for {} not found in timepoints'.format(quantity))
+            self.measurement_mask[rows,j] = True
+            self.measurement_values[rows,j] = a[:,1]
+        # positions of the residuals in the flattened (row-major) matrix
+        self.residual_index = flatnonzero(self.measurement_mask)
+        self.n_residuals = self.residual_index.size
+        # offsets of each timepoint row into the residual vector
+        self.row_offsets = hstack(([0], cumsum(self.measurement_mask.sum(axis=1))))
+        # which quantity each residual belongs to
+        self.residual_quantity = self.residual_index % len(self.quantities)
+        self.quantity_counts = self.measurement_mask.sum(axis=0)
+
+    def setSolverConfig(self, solver_config):
+        # type: (SolverConfig) -> None
+        self.solver_config = solver_config
+        solver_config.apply(self.r)
+
+    def checkDeadline(self):
+        '''
+        Raises SimulationTimeout if the wall-clock limit
+        for the current evaluation has been exceeded.
+        '''
+        if self.deadline is not None and monotonic() > self.deadline:
+            raise SimulationTimeout('Evaluation exceeded wall-clock limit of {} s'.format(self.solver_config.wall_clock_limit))
+
+    def resetResiduals(self):
+        '''
+        Clears the residuals from the last evaluation.
+        Does not reallocate the residual buffer.
+        '''
+        self.residual_count = 0
+        self.measurement_count[:] = 0
+
+    def setResiduals(self, predicted):
+        '''
+        Calculates the residuals for all timepoints at once and writes
+        them to the residual buffer. The predicted values must have one
+        row per timepoint and one column per quantity
+        (in the order of self.quantities).
+        '''
+        subtract(predicted, self.measurement_values, out=self._delta)
+        take(self._delta, self.residual_index, out=self.residuals)
+        self.residual_count = self.n_residuals
+        self.measurement_count += self.quantity_counts
+
+    def setResidualsAtRow(self, row, predicted):
+        '''
+        Calculates the residuals for a single timepoint row and writes
+        them to the corresponding slice of the residual buffer.
+        Entries without a measurement are skipped.
+        '''
+        mask = self.measurement_mask[row]
+        begin,end = self.row_offsets[row],self.row_offsets[row+1]
+        self.residuals[begin:end] = (predicted - self.measurement_values[row])[mask]
+        self.residual_count = max(self.residual_count, end)
+        self.measurement_count += mask
+
+    def setResidualSegment(self, begin_row, end_row, predicted):
+        '''
+        Calculates the residuals for the timepoint rows begin_row
+        up to (not including) end_row and writes them to the
+        corresponding slice of the residual buffer.
+        '''
+        mask = self.measurement_mask[begin_row:end_row]
+        begin,end = self.row_offsets[begin_row],self.row_offsets[end_row]
+        self.residuals[begin:end] = (predicted - self.measurement_values[begin_row:end_row])[mask]
+        self.residual_count = max(self.residual_count, end)
+        self.measurement_count += mask.sum(axis=0)
+
+    def partialSSE(self):
+        '''
+        Sum of squares of the residuals calculated so far.
+        Divided by the total number of residuals, this is a lower
+        bound on the MSE.
+        '''
+        r = self.residuals[:self.residual_count]
+        return dot(r,r)
+
     def calcResiduals(self,t):
-        ''' Try to calculate residuals at the current time t
+        ''' Calculate residuals at the current time t
         and add them to self.residuals.
         If they do not exist for certain datasets at time t,
         just pass over the dataset.'''
-        self.usage_map = dict((q,False) for q in self.measurement_map)
-        for quantity in self.measurement_map.keys():
-            self.tryAddResidual(t, self.r[quantity], quantity)
-
-    def tryAddResidual(self,t,predicted_value,identifier):
-        ''' Append a residual to the list of residuals.
-            Call with a single value from a simulation and pass
-            array of measurements for that quantity.
-            If there is no measurement at this time point (t), do nothing.'''
-        a = self.measurement_map[identifier]
-        try:
-            # if there is a measurement a this timepoint, append to list
-            r = predicted_value - valueAtTime(a,t)
-            self.residuals.append(r)
-            self.quantity_residuals[identifier].append(r)
-            # increment the residual use count (check all measurements are used exactly once)
-            self.measurement_count[identifier] += 1
-            self.usage_map[identifier] = True
-        except MissingValue:
-            # no measurement at this timepoint, do nothing
-            return
+        row = searchsorted(self.timepoints, t)
+        self.setResidualsAtRow(row, array([self.r[quantity] for quantity in self.quantities]))
+
+    def getQuantityResiduals(self, identifier):
+        '''
+        Returns the residuals of the last evaluation for a given quantity.
+        '''
+        j = self.quantities.index(identifier)
+        return self.residuals[:self.residual_count][self.residual_quantity[:self.residual_count] == j]
+
+    def recordDiagnostics(self):
+        '''
+        Appends the residuals of the last evaluation to the
+        per-quantity history.
+        '''
+        for quantity in self.quantities:
+            self.quantity_residuals[quantity].append(self.getQuantityResiduals(quantity))
 
     def plotQuantity(self, identifier, bars=True):
         ''' Plot a simulated quantity vs its data points using Tellurium.
@@ -85,24 +319,24 @@ class TimecourseModel(Evaluator):
         data = self.measurement_map[identifier]
         # data contains one column of time and one column of values
         import tellurium as te
-        te.plot(data[:,0], data[:,1], scatter=True, name=identifier+' data', show=False, error_y_pos=maximum(array(self.quantity_residuals[identifier]),0), error_y_neg=-minimum(array(self.quantity_residuals[identifier]),0))
+        residuals = self.getQuantityResiduals(identifier)
+        te.plot(data[:,0], data[:,1], scatter=True, name=identifier+' data', show=False, error_y_pos=maximum(residuals,0), error_y_neg=-minimum(residuals,0))
         # simulate and plot the model
-        r = RoadRunner(self.sbml)
+        r = get_model(self.sbml)
         s = r.simulate(0,self.timepoints[-1],1000,['time',identifier])
         te.plot(s[:,0], s[:,1], name=identifier+' sim')
 
     def MSE(self):
         ''' Calc the MSE for all residuals.
         Call this after calculating all residuals.'''
-        r = array(self.residuals)
-        return (r**2).mean()
+        r = self.residuals[:self.residual_count]
+        return dot(r,r)/r.size
 
     def simulateToNextTime(self):
         t_begin = self.t
         t_end = self.timepoints[self.next_ti]
         delta = t_end-t_begin
-        stepsize = 0.1
-        steps = int(max(100,delta/stepsize))
+        steps = int(max(self.solver_config.min_steps,delta/self.solver_config.stepsize))
         self.r.simulate(t_begin,t_end,steps)
         return t_end
 
@@ -112,11 +346,124 @@ class TimecourseModel(Evaluator):
         # next time index
         self.next_ti = 0
 
-    def buildResidualList(self):
+    def preequilibrate(self, p):
+        # type: (array) -> None
+        '''
+        Brings the model to steady state for the parameters p, starting
+        from the cached steady state of the nearest parameter vector.
+        Falls back to a solve from the initial state if that fails.
+        '''
+        cache = self.steady_state_cache
+        state,distance = cache.nearest(p)
+        if state is not None and distance <= cache.exact_rtol:
+            cache.hits += 1
+            self.r.model.setFloatingSpeciesAmounts(state)
+            return
+        warm = False
+        if state is not None:
+            self.r.model.setFloatingSpeciesAmounts(state)
+            try:
+                self.r.steadyState()
+                warm = True
+            except RuntimeError:
+                pass
+        if warm:
+            cache.warm_starts += 1
+        else:
+            self.r.resetAll()
+            self.setParameterVector(p)
+            self.r.steadyState()
+            cache.cold_solves += 1
+        self.r.model.setTime(0.)
+        cache.store(p, self.r.model.getFloatingSpeciesAmounts())
+
+    def applyInitialConditions(self):
+        for id,value in self.initial_conditions.items():
+            self.r[id] = value
+
+    def prepare(self, p):
+        # type: (array) -> None
+        '''
+        Resets the model and sets up the initial state for the model
+        parameters p (pre-equilibration, then initial conditions).
+        '''
+        self.reset()
+        self.setParameterVector(p)
+        if self.steady_state_cache is not None:
+            self.preequilibrate(p)
+        self.applyInitialConditions()
+
+    def simulateSinglePass(self):
+        '''
+        Integrate once from zero to the last timepoint and return
+        the result matrix. Rows correspond to self.timepoints and
+        columns to self.selections.
+        '''
+        s = self.r.simulate(times=self.output_times, selections=self.selections)
+        # drop the initial state if zero is not a measurement time
+        return s[len(self.output_times)-len(self.timepoints):,:]
+
+    def buildResidualListSinglePass(self):
+        if len(self.timepoints) < 2:
+            raise RuntimeError('Expected at least two timepoints')
+        s = self.simulateSinglePass()
+        self.t = self.timepoints[-1]
+        self.setResiduals(s[:,1:])
+        return True
+
+    def buildResidualListSegmented(self, bound):
+        '''
+        Like buildResidualListSinglePass, but integrates in
+        self.abort_segments segments and stops as soon as the
+        residuals so far prove that the MSE exceeds bound (if given).
+        Returns False if the simulation was stopped early.
+        Also used to enforce the wall-clock limit.
+        '''
+        if len(self.timepoints) < 2:
+            raise RuntimeError('Expected at least two timepoints')
+        n = len(self.timepoints)
+        # row boundaries of the segments, first segment has at least two rows
+        edges = unique(hstack(([0], linspace(min(2,n), n, self.abort_segments).astype(int))))
+        offset = len(self.output_times)-n
+        for begin_row,end_row in zip(edges[:-1],edges[1:]):
+            if begin_row == 0:
+                times = self.output_times[:end_row+offset]
+            else:
+                # continue from the last output time
+                times = self.timepoints[begin_row-1:end_row]
+            s = self.r.simulate(times=times, selections=self.selections)
+            self.t = self.timepoints[end_row-1]
+            self.setResidualSegment(begin_row, end_row, s[len(times)-(end_row-begin_row):,1:])
+            if bound is not None and self.partialSSE() > bound*self.n_residuals:
+                return False
+            self.checkDeadline()
+        return True
+
+    def buildResidualList(self, bound=None):
+        '''
+        Simulates the model and calculates the residuals.
+        If bound is given, the simulation may be stopped as soon as
+        the MSE is known to exceed it, in which case False is returned.
+        '''
+        self.resetResiduals()
+        if self.solver_config.wall_clock_limit is not None:
+            self.deadline = monotonic() + self.solver_config.wall_clock_limit
+        else:
+            self.deadline = None
+        if self.single_pass and bound is None and self.deadline is None:
+            complete = self.buildResidualListSinglePass()
+        elif self.single_pass:
+            complete = self.buildResidualListSegmented(bound)
+        else:
+            complete = self.buildResidualListStepwise(bound)
+        if self.diagnostics:
+            self.recordDiagnostics()
+        return complete
+
+    def buildResidualListStepwise(self, bound=None):
         # simulate to the first timepoint (not necessarily zero)
         delta = self.timepoints[0]
-        stepsize = 0.1
-        steps = int(max(100,delta/stepsize))
+        steps = int(max(self.solver_config.min_steps,delta/self.solver_config.stepsize))
         self.r.simulate(0,delta,steps)
         self.next_ti = 1
         if len(self.timepoints) < 2:
@@ -125,30 +472,187 @@ class TimecourseModel(Evaluator):
         self.calcResiduals(self.t)
         # simulate to the rest of the timepoints
         while self.next_ti < self.timepoints.shape[0]:
+            if bound is not None and self.partialSSE() > bound*self.n_residuals:
+                return False
+            self.checkDeadline()
             self.t = self.simulateToNextTime()
             self.calcResiduals(self.t)
             self.next_ti += 1
+        return True
+
+    def encodeParameters(self, p):
+        # type: (array) -> array
+        '''
+        Converts model parameter values to a decision vector.
+        Use this for bounds and initial guesses.
+        '''
+        return log10(p) if self.log_params else asarray(p)
+
+    def decodeParameters(self, x):
+        # type: (array) -> array
+        '''
+        Converts a decision vector (e.g. a migrant or champion)
+        back to model parameter values.
+        '''
+        return power(10., x) if self.log_params else asarray(x)
 
-    def setParameterVector(self, x, param_list):
+    def setParameterVector(self, x, param_list=None):
         # type: (array, List) -> None
-        # TODO: sample in log space
+        '''
+        Sets the model parameter values (always in linear space).
+        '''
+        if param_list is None or param_list is self.param_list:
+            param_list = self.param_list
+            indices = self.param_indices
+        else:
+            indices = global_parameter_indices(self.r, param_list)
         expect(len(x) == len(param_list), 'Wrong length for parameter vector - expected {} but got {}'.format(len(param_list), len(x)))
-        for i,v in enumerate(x):
-            self.r[param_list[i]] = v
+        set_parameter_values(self.r, param_list, indices, x)
 
-    def evaluate(self, x):
-        # type: (array) -> SupportsFloat
+    def evaluateBounded(self, x, bound):
+        # type: (array, float) -> typing.Tuple[float,bool]
         """
-        Evaluate and return the objective function.
+        Evaluate the objective function, stopping early if it is
+        known to exceed bound (e.g. the worst fitness on the island).
+        Returns a tuple of the score and a flag which is true if the
+        score is exact. If the flag is false, the score is only a lower
+        bound on the objective (and is greater than bound).
         """
-        self.reset()
-        self.setParameterVector(x)
         try:
-            self.buildResidualList()
+            self.prepare(self.decodeParameters(x))
+            complete = self.buildResidualList(bound)
+        except SimulationTimeout:
+            self.timeout_evaluations += 1
+            self.penalty_evaluations += 1
+            return (self.solver_config.penalty, True)
         except RuntimeError:
             # if convergence fails, use a penalty score
-            return 1e9
-        return self.MSE()
+            self.penalty_evaluations += 1
+            return (self.solver_config.penalty, True)
+        if not complete:
+            self.aborted_evaluations += 1
+            return (self.partialSSE()/self.n_residuals, False)
+        return (self.MSE(), True)
+
+    @property
+    def penalty(self):
+        # type: () -> float
+        '''
+        Score assigned when a simulation fails or times out.
+        '''
+        return self.solver_config.penalty
+
+    def evaluate(self, x, bound=None):
+        # type: (array, typing.Optional[float]) -> SupportsFloat
+        """
+        Evaluate and return the objective function.
+        x is a decision vector, see decodeParameters.
+        If bound is given, see evaluateBounded.
+        """
+        return self.evaluateBounded(x, bound)[0]
+
+    def residualJacobian(self, p, max_grid_size=100000):
+        # type: (array, int) -> array
+        '''
+        Computes the Jacobian of the residual vector with respect to
+        the model parameters p (ordered as self.param_list) using
+        RoadRunner's forward sensitivity solver, and the residuals for
+        p (left in the residual buffer). The sensitivity solver only
+        supports uniform output grids, so the grid step is the largest
+        step that hits all measurement times. It does not return the
+        trajectory, so the residuals take a plain simulation from the
+        same prepared initial state.
+        '''
+        expect(self.param_list is not None, 'Parameter list required for sensitivities')
+        h = common_time_step(self.output_times)
+        n_grid = int(rint(self.output_times[-1]/h))+1
+        expect(n_grid <= max_grid_size, 'Sensitivity grid too large ({} points)'.format(n_grid))
+        self.prepare(p)
+        initial_state = self.r.model.getFloatingSpeciesAmounts()
+        time,sens,params,species = self.r.timeSeriesSensitivities(0., self.output_times[-1], n_grid, self.param_list, self.quantities)
+        # sens is indexed by (time, parameter, species)
+        rows = rint(self.timepoints/h).astype(int)
+        columns = [list(species).index(q) for q in self.quantities]
+        # reorder to (time, quantity, parameter) to match the residual ordering
+        s = sens[rows][:,:,columns].transpose(0,2,1).reshape(-1, len(p))
+        # rewind instead of preparing again (which may pre-equilibrate),
+        # the sensitivity solver leaves the parameters perturbed
+        self.setParameterVector(p)
+        self.r.model.setTime(0.)
+        self.r.model.setFloatingSpeciesAmounts(initial_state)
+        self.applyInitialConditions()
+        expect(self.buildResidualList(), 'Incomplete simulation')
+        return s[self.residual_index]
+
+    def relativeTolerance(self):
+        # type: () -> float
+        '''
+        Relative tolerance of the current integrator
+        (1e-6 if it has no such setting).
+        '''
+        integrator = self.r.getIntegrator()
+        if 'relative_tolerance' in integrator.getSettings():
+            return float(integrator.getValue('relative_tolerance'))
+        return 1e-6
+
+    def residualJacobianFD(self, p, rel_step=None, rtol=1e-10, atol=1e-12):
+        # type: (array, typing.Optional[float], typing.Optional[float], typing.Optional[float]) -> array
+        '''
+        Computes the Jacobian of the residual vector with respect to
+        the model parameters p using forward differences (one extra
+        simulation per parameter), and the residuals for p (left in the
+        residual buffer). With the default integrator tolerances, the
+        integration error is about as large as the change due to a
+        small step, so all of these simulations run with the tightened
+        tolerances rtol and atol (None keeps the current setting).
+
+        :param rel_step: Step relative to each parameter. Defaults to the square root of the relative tolerance.
+        '''
+        solver_config = self.solver_config
+        self.setSolverConfig(attr.evolve(solver_config,
+            rtol=rtol if rtol is not None else solver_config.rtol,
+            atol=atol if atol is not None else solver_config.atol))
+        try:
+            if rel_step is None:
+                rel_step = sqrt(self.relativeTolerance())
+            self.prepare(p)
+            expect(self.buildResidualList(), 'Incomplete simulation')
+            r0 = self.residuals.copy()
+            J = empty((self.n_residuals, len(p)))
+            for k in range(len(p)):
+                dp = rel_step*max(abs(p[k]), 1e-12)
+                q = p.copy()
+                q[k] += dp
+                self.prepare(q)
+                expect(self.buildResidualList(), 'Incomplete simulation')
+                J[:,k] = (self.residuals - r0)/dp
+            self.residuals[:] = r0
+        finally:
+            self.setSolverConfig(solver_config)
+        return J
+
+    def gradient(self, x, method='fd'):
+        # type: (array, str) -> array
+        '''
+        Gradient of the MSE with respect to the decision vector x.
+        method can be 'sensitivity' (forward sensitivity analysis) or
+        'fd' (forward differences). Not every model is supported by
+        RoadRunner's sensitivity solver, and it is much more expensive
+        per simulation, so 'fd' is the default.
+        '''
+        p = asarray(self.decodeParameters(x), dtype=float)
+        if method == 'sensitivity':
+            J = self.residualJacobian(p)
+        elif method == 'fd':
+            J = self.residualJacobianFD(p)
+        else:
+            raise RuntimeError('Unknown gradient method {}'.format(method))
+        # both methods leave the residuals for p in the buffer
+        g = 2.*J.T.dot(self.residuals)/self.n_residuals
+        if self.log_params:
+            # chain rule for p = 10**x
+            g *= p*log(10.)
+        return g
 
     def getUsageByQuantity(self):
         '''
@@ -160,9 +664,9 @@ class TimecourseModel(Evaluator):
         total_used = 0
         usage_for_quantity = OrderedDict()
 
-        for q in self.measurement_count:
+        for q,used in zip(self.quantities,self.measurement_count):
             a = self.measurement_map[q]
-            used = self.measurement_count[q]
+            used = int(used)
             usage_for_quantity[q] = used
             n = a.shape[0]
             total+=n
@@ -174,7 +678,7 @@ class TimecourseModel(Evaluator):
         ''' For debugging. Make sure every data point is
         used.'''
         total,total_used,usage_for_quantity = self.getUsageByQuantity()
-        for q,used in usage_for_quantity.keys():
+        for q,used in usage_for_quantity.items():
             a = self.measurement_map[q]
             n = a.shape[0]
             print('Usage for {}: {}/{}'.format(q,used,n))
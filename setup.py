@@ -8,7 +8,7 @@ setup(name='sabaody',
       author='Shaik Asifullah, J. Kyle Medley',
       packages=['sabaody'],
       install_requires=[
-        'numpy>=1.14.2',
+        'numpy>=1.17',
         'tellurium>=2.0.12',
         'networkx>=2.1',
         'pygmo>=2.7',
@@ -19,7 +19,6 @@ setup(name='sabaody',
         'arrow>=0.12.1',
         'tornado>=5.0.2',
         'pytest-tornado>=0.5.0', # only for testing
-        'APScheduler>=3.5.1',
         'requests>=2.18.0',
         'yarl>=1.2.4',
         'attrs>=18.1.0',
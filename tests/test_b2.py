@@ -22,4 +22,117 @@ def test_datapoint_usage():
     for q,used in usage_for_quantity.items():
         a = b2.measurement_map[q]
         n = a.shape[0]
-        assert used == n
\ No newline at end of file
+        assert used == n
+
+def test_single_pass_matches_stepwise():
+    '''
+    The single pass simulation should give the same score as
+    restarting the integrator at every measurement time.
+    '''
+    sbml = os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml')
+    single = B2Problem(sbml)
+    stepwise = B2Problem(sbml)
+    stepwise.single_pass = False
+    assert abs(single.evaluate(getDefaultParamValues()) - stepwise.evaluate(getDefaultParamValues())) < 1e-4
+    assert single.getUsageByQuantity()[:2] == stepwise.getUsageByQuantity()[:2]
+
+def test_residuals_reset_per_evaluation():
+    '''
+    Residuals should be overwritten on every evaluation, not accumulated.
+    '''
+    b2 = B2Problem(os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml'))
+    score = b2.evaluate(getDefaultParamValues())
+    n = b2.residuals.size
+    assert b2.evaluate(getDefaultParamValues()) == score
+    assert b2.residuals.size == n
+    total,total_used,usage_for_quantity = b2.getUsageByQuantity()
+    assert total == total_used
+
+def test_batch_evaluation():
+    '''
+    Batch evaluation in worker processes should match serial evaluation.
+    '''
+    from sabaody import BatchEvaluator
+    from toolz import partial
+    from numpy import vstack, allclose
+    sbml = os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml')
+    X = vstack((getDefaultParamValues(), 1.1*getDefaultParamValues(), 0.9*getDefaultParamValues()))
+    serial = B2Problem(sbml).evaluateBatch(X)
+    b = BatchEvaluator(partial(B2Problem, sbml), processes=2)
+    try:
+        assert allclose(b.evaluateBatch(X), serial)
+    finally:
+        b.close()
+
+def test_log_params():
+    '''
+    Evaluating the log10 of the parameters in log mode should give the
+    same score as evaluating the parameters directly.
+    '''
+    from numpy import log10, allclose
+    sbml = os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml')
+    linear = B2Problem(sbml)
+    log = B2Problem(sbml, log_params=True)
+    assert allclose(log.encodeParameters(getDefaultParamValues()), log10(getDefaultParamValues()))
+    assert allclose(log.decodeParameters(log10(getDefaultParamValues())), getDefaultParamValues())
+    assert abs(log.evaluate(log10(getDefaultParamValues())) - linear.evaluate(getDefaultParamValues())) < 1e-4
+
+def test_bounded_evaluation():
+    '''
+    Evaluating with an upper bound should stop early and return a
+    lower bound on the score if the bound cannot be met.
+    '''
+    b2 = B2Problem(os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml'))
+    score = b2.evaluate(getDefaultParamValues())
+    # bound is not hit, result should be exact
+    f,exact = b2.evaluateBounded(getDefaultParamValues(), 2.*score)
+    assert exact
+    assert abs(f - score) < 1e-4
+    # bound is hit
+    f,exact = b2.evaluateBounded(getDefaultParamValues(), 0.01*score)
+    assert not exact
+    assert 0.01*score < f <= score
+    assert b2.aborted_evaluations == 1
+    # stepwise mode
+    b2.single_pass = False
+    f,exact = b2.evaluateBounded(getDefaultParamValues(), 0.01*score)
+    assert not exact
+    assert 0.01*score < f <= score
+
+def test_solver_config():
+    '''
+    Test the integrator settings and the penalty counters.
+    '''
+    from sabaody.timecourse_model import SolverConfig
+    sbml = os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml')
+    b2 = B2Problem(sbml, solver_config=SolverConfig(rtol=1e-8, atol=1e-10))
+    assert b2.r.getIntegrator().getValue('relative_tolerance') == 1e-8
+    assert b2.evaluate(getDefaultParamValues()) < 1.
+    assert b2.penalty_evaluations == 0
+    # too few steps to reach the first output time
+    b2.setSolverConfig(SolverConfig(max_steps=2, penalty=1e6))
+    assert b2.evaluate(getDefaultParamValues()) == 1e6
+    assert b2.penalty_evaluations == 1
+    # every evaluation exceeds a zero time limit
+    b2.setSolverConfig(SolverConfig(wall_clock_limit=0.))
+    assert b2.evaluate(getDefaultParamValues()) == 1e9
+    assert b2.timeout_evaluations == 1
+    assert b2.penalty_evaluations == 2
+
+def test_gradient_step():
+    '''
+    The forward difference gradient of B2 should not be dominated by
+    integration error: it should agree with a ten times larger step.
+    '''
+    from numpy import median, sign
+    b2 = B2Problem(os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml'))
+    p = 1.3*getDefaultParamValues()
+    g = b2.gradient(p, 'fd')
+    # the default step is sqrt(1e-10)
+    J = b2.residualJacobianFD(p, rel_step=1e-4)
+    g_large = 2.*J.T.dot(b2.residuals)/b2.n_residuals
+    nonzero = g_large != 0.
+    assert median(abs(g - g_large)[nonzero]/abs(g_large[nonzero])) < 0.1
+    assert (sign(g) == sign(g_large))[nonzero].mean() > 0.9
+    # the integrator settings are restored
+    assert b2.relativeTolerance() == 1e-6
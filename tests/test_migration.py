@@ -42,4 +42,162 @@ def test_migration_policies():
         [1.,2.,3.],
         [4.,5.,6.],
         [9.,9.,9.],
-        [8.,9.,9.]]))
\ No newline at end of file
+        [8.,9.,9.]]))
+
+def test_partial_sort():
+    '''
+    Partial sort should agree with a full sort, and replacement
+    through a snapshot should keep the snapshot in sync.
+    '''
+    from sabaody.migration import best_indices, sort_by_fitness, PopulationSnapshot, FairRPolicy
+    from pygmo import population, rosenbrock
+    from numpy import argsort
+    from numpy.random import RandomState
+    f = RandomState(0).uniform(size=100)
+    for n in (0, 1, 5, 100, 200):
+        assert array_equal(best_indices(f, n), argsort(f)[:n])
+
+    p = population(prob=rosenbrock(2), size=0, seed=0)
+    for k in range(10):
+        p.push_back(array([float(k), 0.]), array([float(k)]))
+    x,fx = sort_by_fitness(p, 3)
+    assert array_equal(fx[:,0], array([0.,1.,2.]))
+    # selection copies the fitness values only once
+    from sabaody.migration import BestSPolicy
+    class CountingPopulation:
+        n_get_f = 0
+        def get_f(self):
+            self.n_get_f += 1
+            return p.get_f()
+        def get_x(self):
+            return p.get_x()
+    c = CountingPopulation()
+    x,fx = BestSPolicy(migration_rate=2).select(c)
+    assert array_equal(fx[:,0], array([0.,1.])) and c.n_get_f == 1
+    s = PopulationSnapshot(p)
+    deltas = FairRPolicy().replace(s, array([[-1.,-1.],[-2.,-2.]]), array([[-1.],[-2.]]))
+    assert deltas == [-11.,-9.]
+    assert array_equal(s.get_f(), p.get_f())
+    assert array_equal(s.get_x(), p.get_x())
+
+def test_additional_policies():
+    '''
+    Test random and tournament selection, worst and random
+    replacement, and migrant routing.
+    '''
+    from sabaody.migration import RandomSPolicy, TournamentSPolicy, WorstRPolicy, RandomRPolicy, \
+        MigrationPolicyEachToAll, MigrationPolicyUniform
+    from pygmo import population, rosenbrock
+    from numpy import concatenate
+    def make_population():
+        p = population(prob=rosenbrock(2), size=0, seed=0)
+        for k in range(10):
+            p.push_back(array([float(k), 0.]), array([float(k)]))
+        return p
+    p = make_population()
+
+    x,f = RandomSPolicy(migration_rate=4, seed=0).select(p)
+    assert x.shape == (4,2) and f.shape == (4,1)
+    assert len(set(f[:,0])) == 4
+    assert array_equal(x[:,0], f[:,0])
+    # a tournament over the whole population always picks the best
+    x,f = TournamentSPolicy(pop_fraction=0.3, tournament_size=1000, seed=0).select(p)
+    assert array_equal(f[:,0], array([0.,0.,0.]))
+
+    candidates = array([[-1.,-1.],[20.,20.]])
+    candidate_f = array([[-1.],[20.]])
+    deltas = WorstRPolicy().replace(p, candidates, candidate_f)
+    assert deltas == [-10.,12.]
+    assert sort(p.get_f()[:,0]).tolist() == [-1.,0.,1.,2.,3.,4.,5.,6.,7.,20.]
+    p = make_population()
+    deltas = RandomRPolicy(seed=0).replace(p, candidates, candidate_f)
+    # only the better candidate is accepted
+    assert len(deltas) == 1 and deltas[0] < 0
+    assert p.get_f()[:,0].min() == -1. and p.get_f()[:,0].max() == 9.
+    # worst replacement uses the best candidates if there are too many
+    p = make_population()
+    many = array([[float(k), float(k)] for k in range(20, 8, -1)])
+    deltas = WorstRPolicy().replace(p, many, many[:,:1])
+    assert sort(p.get_f()[:,0]).tolist() == [float(k) for k in range(9, 19)]
+    # empty pulls (e.g. from the JSON wire format) and empty populations
+    empty_f = array([[f] for f in []])
+    assert WorstRPolicy().replace(p, array([]), empty_f) == []
+    assert RandomRPolicy(seed=0).replace(p, array([]), empty_f) == []
+    x,f = TournamentSPolicy(migration_rate=2, seed=0).select(population(prob=rosenbrock(2), size=0, seed=0))
+    assert x.shape[0] == 0 and f.shape[0] == 0
+
+    routes = MigrationPolicyEachToAll().route(['a','b'], 3)
+    assert [id for id,_ in routes] == ['a','b']
+    assert all(array_equal(indices, array([0,1,2])) for _,indices in routes)
+    routes = MigrationPolicyUniform(seed=0).route(['a','b','c'], 20)
+    # every migrant is sent exactly once
+    assert array_equal(sort(concatenate([indices for _,indices in routes])), array(range(20)))
+    assert MigrationPolicyUniform().route([], 5) == []
+
+def test_background_migrator():
+    '''
+    Migrants sent in the background should be applied
+    on the next call to receiveMigrants.
+    '''
+    from sabaody.migration import Migrator, BackgroundMigrator, BestSPolicy, FairRPolicy, PopulationSnapshot
+    from pygmo import population, rosenbrock
+    from numpy import vstack
+    from pytest import raises
+
+    class LocalMigrator(Migrator):
+        def __init__(self):
+            super().__init__(BestSPolicy(migration_rate=1), FairRPolicy())
+            self.pools = {'a': [], 'b': []}
+
+        def pushMigrant(self, dest_island_id, migrant_vector, fitness, src_island_id=None, expiration_time=None):
+            self.pools[dest_island_id].append((migrant_vector, fitness, src_island_id))
+
+        def pullMigrants(self, island_id, n=0):
+            migrants,self.pools[island_id] = self.pools[island_id],[]
+            if not migrants:
+                return (array([]), array([]).reshape(0,1), [])
+            return (vstack([m for m,f,s in migrants]), vstack([f for m,f,s in migrants]), [s for m,f,s in migrants])
+
+    class Ring:
+        def outgoing_ids(self, id):
+            return ['b'] if id == 'a' else ['a']
+
+    migrator = LocalMigrator()
+    a = BackgroundMigrator(migrator, 'a', Ring())
+    b = BackgroundMigrator(migrator, 'b', Ring())
+    pa = population(prob=rosenbrock(2), size=0, seed=0)
+    pa.push_back(array([1.,1.]), array([0.]))
+    pa.push_back(array([2.,2.]), array([5.]))
+    pb = population(prob=rosenbrock(2), size=0, seed=0)
+    pb.push_back(array([3.,3.]), array([7.]))
+    pb.push_back(array([4.,4.]), array([8.]))
+
+    a.sendMigrants(pa)
+    a.flush()
+    b.sendMigrants(pb)
+    b.flush()
+    # b pulled the champion of a
+    s = PopulationSnapshot(pb)
+    deltas,src_ids = b.receiveMigrants(s)
+    assert deltas == [-8.] and src_ids == ['a']
+    assert array_equal(sort(pb.get_f()[:,0]), array([0.,7.]))
+    # nothing new arrived
+    assert b.receiveMigrants(pb) == ([],[])
+    a.close()
+    b.close()
+    assert a.n_errors == 0 and b.n_errors == 0
+
+    # failures in the background are re-raised
+    class DeadMigrator(LocalMigrator):
+        def pullMigrants(self, island_id, n=0):
+            raise RuntimeError('Migration service unreachable')
+    c = BackgroundMigrator(DeadMigrator(), 'a', Ring())
+    c.sendMigrants(pa)
+    c.sendMigrants(pa)
+    c.flush()
+    assert c.n_errors == 2
+    with raises(RuntimeError):
+        c.receiveMigrants(pa)
+    # only the first failure is raised
+    assert c.receiveMigrants(pa) == ([],[])
+    c.close()
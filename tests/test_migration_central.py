@@ -3,7 +3,7 @@ from __future__ import print_function, division, absolute_import
 from toolz import partial
 from numpy import array, array_equal
 import arrow
-from pytest import fixture
+from pytest import fixture, mark
 
 from uuid import uuid4
 from time import sleep
@@ -11,26 +11,27 @@ import sys
 
 # Tornado fixtures
 
-#@fixture
-#def app():
-    #from sabaody.migration_central import create_central_migration_service
-    #return create_central_migration_service()
+@fixture
+def app():
+    from sabaody.migration_central import create_central_migration_service
+    return create_central_migration_service()
 
 # Unit tests
 
 def test_migration_client(mocker):
     '''
     Test the client methods, including defineMigrantPool and pushMigrant.
-    requests.post is patched so post requests are never actually sent.
+    Session.post is patched so post requests are never actually sent.
     '''
-    mocker.patch('requests.post')
+    mocker.patch('requests.Session.post')
     from sabaody.migration_central import CentralMigrator
     # url doesn't matter, requests never sent
     m = CentralMigrator('http://www.schneierfacts.com:10100', None, None)
 
     island_id = uuid4()
     m.defineMigrantPool(island_id, 4)
-    from requests import post
+    from requests import Session
+    post = Session.post
     if sys.version_info >= (3,6):
         post.assert_called_once()
     post.reset_mock()
@@ -38,6 +39,33 @@ def test_migration_client(mocker):
     if sys.version_info >= (3,6):
         post.assert_called_once()
     post.reset_mock()
+    # all destinations in one request
+    m.pushMigrants('src', [
+      (island_id, array([[1., 2., 3., 4.], [5., 6., 7., 8.]]), array([[1.], [2.]])),
+      (uuid4(), array([[1., 2., 3., 4.]]), array([[1.]])),
+      ])
+    if sys.version_info >= (3,6):
+        post.assert_called_once()
+    post.reset_mock()
+
+def test_migration_client_default_expiration(mocker):
+    '''
+    Default expiration times should be computed per request,
+    not when the module was imported.
+    '''
+    post = mocker.patch('requests.Session.post')
+    from sabaody.migration_central import CentralMigrator
+    from sabaody.migration import BestSPolicy, FairRPolicy
+    m = CentralMigrator('http://localhost:10100', BestSPolicy(migration_rate=1), FairRPolicy(), wire_format='json')
+    # pretend sabaody was imported two days ago
+    later = arrow.utcnow().shift(days=+2)
+    mocker.patch('arrow.utcnow', return_value=later)
+    m.defineMigrantPool('a', 2)
+    assert arrow.get(post.call_args[1]['json']['expiration_time']) > later
+    m.pushMigrant('a', array([1., 2.]), 1.)
+    assert arrow.get(post.call_args[1]['json']['expiration_time']) > later
+    m.pushMigrants('src', [('a', array([[1., 2.]]), array([[1.]]))])
+    assert arrow.get(post.call_args[1]['json']['expiration_time']) > later
 
 def test_migration_buffer():
     '''
@@ -65,3 +93,200 @@ def test_migration_host():
     sleep(1) # make sure island expires
     m.garbageCollect()
     assert len(m._migrant_pools) == 0
+
+def test_migration_host_bulk_push():
+    '''
+    Test pushing migrants to several pools at once.
+    '''
+    from sabaody.migration_central import MigrationServiceHost
+    m = MigrationServiceHost()
+    m.defineMigrantPool('a', 2, 'FIFO', arrow.utcnow().shift(days=+1))
+    m.defineMigrantPool('b', 2, 'FIFO', arrow.utcnow().shift(days=+1))
+    m.pushMigrants([
+      {'dest_island_id': 'a', 'migrants': [[1.,2.],[3.,4.]], 'fitness': [1.,2.]},
+      {'dest_island_id': 'b', 'migrants': [[5.,6.]], 'fitness': [3.]},
+      ], src_island_id='c')
+    assert len(m.popMigrants('a', 0)) == 2
+    migrants = m.popMigrants('b', 0)
+    assert array_equal(migrants[0][0], array([5.,6.]))
+    assert migrants[0][1:] == (3., 'c')
+    # nothing is pushed if any destination is invalid
+    from pytest import raises
+    with raises(RuntimeError):
+        m.pushMigrants([
+          {'dest_island_id': 'a', 'migrants': [[1.,2.]], 'fitness': [1.]},
+          {'dest_island_id': 'x', 'migrants': [[1.,2.]], 'fitness': [1.]},
+          ])
+    assert len(m.popMigrants('a', 0)) == 0
+
+def test_migrant_codec():
+    '''
+    Test the binary encoding of migrants.
+    '''
+    from sabaody.migrant_codec import encode_migrants, encode_migrant_frames, decode_migrant_frames
+    from pytest import raises
+    migrants = array([[1.,2.,3.],[4.,5.,6.]])
+    data = encode_migrant_frames([
+      (migrants, array([[1.],[2.]]), {'dest_island_id': 'a', 'src_island_id': ['b','c']}),
+      (array([]).reshape(0,3), array([]), None),
+      ])
+    frames = decode_migrant_frames(data)
+    assert len(frames) == 2
+    assert array_equal(frames[0][0], migrants)
+    assert array_equal(frames[0][1], array([1.,2.]))
+    assert frames[0][2] == {'dest_island_id': 'a', 'src_island_id': ['b','c']}
+    assert frames[1][0].shape == (0,3) and frames[1][2] == {}
+    # single vector
+    assert array_equal(decode_migrant_frames(encode_migrants(array([1.,2.]), 3.))[0][0], array([[1.,2.]]))
+    with raises(RuntimeError):
+        decode_migrant_frames(data[:-1])
+
+def test_migration_host_bulk_pop_and_shards():
+    '''
+    Test popping from several pools at once and
+    sharding of islands across hosts.
+    '''
+    from sabaody.migration_central import MigrationServiceHost, island_shard
+    from pytest import raises
+    m = MigrationServiceHost()
+    for id in ('a','b'):
+        m.defineMigrantPool(id, 2, 'FIFO', arrow.utcnow().shift(days=+1))
+        m.pushMigrant(id, array([1.,2.]), 1., 'c')
+    islands = m.popMigrantsBulk(['a','b'])
+    assert list(islands.keys()) == ['a','b']
+    assert all(len(migrants) == 1 for migrants in islands.values())
+    with raises(RuntimeError):
+        m.popMigrantsBulk(['a','x'])
+
+    ids = [str(uuid4()) for k in range(20)]
+    shards = [island_shard(id, 3) for id in ids]
+    # stable and in range
+    assert shards == [island_shard(id, 3) for id in ids]
+    assert set(shards) <= {0,1,2}
+    h = MigrationServiceHost(shard_index=0, n_shards=3)
+    for id,shard in zip(ids,shards):
+        if shard == 0:
+            h.defineMigrantPool(id, 2, 'FIFO', arrow.utcnow().shift(days=+1))
+        else:
+            with raises(RuntimeError):
+                h.defineMigrantPool(id, 2, 'FIFO', arrow.utcnow().shift(days=+1))
+
+@mark.gen_test
+def test_migration_host_long_poll(io_loop):
+    '''
+    Waiting for migrants should return as soon as enough migrants
+    are pushed, or after the timeout.
+    '''
+    from sabaody.migration_central import MigrationServiceHost
+    from time import monotonic
+    m = MigrationServiceHost()
+    m.defineMigrantPool('a', 2, 'FIFO', arrow.utcnow().shift(days=+1))
+
+    io_loop.call_later(0.05, m.pushMigrant, 'a', array([1.,2.]), 1.)
+    io_loop.call_later(0.1, m.pushMigrant, 'a', array([3.,4.]), 2.)
+    start = monotonic()
+    yield m.waitForMigrants('a', 2, 10.)
+    assert monotonic() - start < 5.
+    assert len(m.popMigrants('a', 5)) == 2
+    assert not m._waiters
+
+    start = monotonic()
+    yield m.waitForMigrants('a', 1, 0.1)
+    assert monotonic() - start >= 0.1
+    assert not m._waiters
+
+@mark.gen_test
+def test_pop_migrants_handler_long_poll(http_client, base_url):
+    '''
+    A pop request with min_count and timeout should be
+    answered once enough migrants have been pushed.
+    '''
+    from tornado.escape import json_decode, json_encode
+    from tornado.gen import sleep
+    from time import monotonic
+    def post(path, args):
+        return http_client.fetch(base_url + path, method='POST', body=json_encode(args))
+    yield post('/define-island/a', {'param_vector_size': 2, 'buffer_type': 'FIFO', 'expiration_time': arrow.utcnow().shift(days=+1).isoformat()})
+    start = monotonic()
+    pop = post('/a/pop-migrants', {'n': 0, 'min_count': 2, 'timeout': 10.})
+    yield sleep(0.05)
+    assert not pop.done()
+    yield post('/a/push-migrant', {'migrant_vector': [1.,2.], 'fitness': 1.})
+    yield post('/a/push-migrant', {'migrant_vector': [3.,4.], 'fitness': 2.})
+    response = yield pop
+    assert monotonic() - start < 5.
+    assert sorted(json_decode(response.body)['fitness']) == [1.,2.]
+    # times out with whatever is there (n defaults to all)
+    start = monotonic()
+    response = yield post('/a/pop-migrants', {'min_count': 1, 'timeout': 0.1})
+    assert monotonic() - start >= 0.1
+    assert json_decode(response.body)['migrants'] == []
+
+def test_ring_migration_buffer():
+    '''
+    The ring buffer pops oldest first and
+    overwrites the oldest migrants when full.
+    '''
+    from sabaody.migration_central import RingMigrationBuffer
+    from pytest import raises
+    b = RingMigrationBuffer(buffer_size=3, param_vector_size=2)
+    for k in range(4):
+        b.push(array([k, k+.5]), float(k), str(k))
+    assert len(b) == 3
+    migrants,fitness,src_ids = b.popArrays(2)
+    assert array_equal(migrants, array([[1.,1.5],[2.,2.5]]))
+    assert array_equal(fitness, array([1.,2.]))
+    assert src_ids == ['1','2']
+    # wrap around
+    b.push(array([4.,4.5]), 4.)
+    b.push(array([5.,5.5]), 5.)
+    migrants = b.pop()
+    assert [f for v,f,s in migrants] == [3.,4.,5.]
+    assert len(b) == 0 and b.popArrays()[0].shape == (0,2)
+    with raises(RuntimeError):
+        b.push(array([1.,2.,3.]), 1.)
+
+def test_best_migration_buffer():
+    '''
+    The best-k buffer keeps only the best migrants
+    and pops them best first.
+    '''
+    from sabaody.migration_central import BestMigrationBuffer
+    b = BestMigrationBuffer(buffer_size=3)
+    for f in [5., 1., 4., 2., 6., 3.]:
+        b.push(array([f, f]), f, str(f))
+    assert len(b) == 3
+    # 5. and 4. were evicted, 6. was discarded on arrival
+    assert b.discarded == 3
+    migrants = b.pop(2)
+    assert [f for v,f,s in migrants] == [1., 2.]
+    assert array_equal(migrants[0][0], array([1.,1.]))
+    assert migrants[0][2] == '1.0'
+    b.push(array([0.,0.]), 0.)
+    migrants,fitness,src_ids = b.popArrays()
+    assert array_equal(fitness, array([0.,3.]))
+    assert len(b) == 0
+
+def test_migration_host_expiration():
+    '''
+    Pushing with an expiration time extends the lifetime of a pool,
+    and garbage collection evicts expired pools incrementally.
+    '''
+    from sabaody.migration_central import MigrationServiceHost
+    m = MigrationServiceHost()
+    soon = arrow.utcnow().shift(seconds=+1)
+    for id in ['a','b','c','d']:
+        m.defineMigrantPool(id, 2, 'FIFO', soon)
+    m.pushMigrant('a', array([1.,2.]), 1., expiration_time=arrow.utcnow().shift(days=+1))
+    m.pushMigrants([{'dest_island_id': 'b', 'migrants': [[1.,2.]], 'fitness': [1.]}],
+                   expiration_time=arrow.utcnow().shift(days=+1))
+    # pushes without an expiration time do not extend the pool
+    m.pushMigrant('c', array([1.,2.]), 1.)
+    assert m.garbageCollect() == 0
+    sleep(1.1)
+    assert m.garbageCollect(max_evictions=1) == 1
+    assert m.garbageCollect() == 1
+    assert sorted(m._migrant_pools) == ['a','b']
+    assert m.stats() == {'pools': 2, 'migrants': 2, 'evicted': 2}
+    # extended pools were rescheduled, not dropped from the heap
+    assert len(m._expirations) == 2
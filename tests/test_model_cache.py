@@ -0,0 +1,56 @@
+from __future__ import print_function, division, absolute_import
+
+import os
+
+b2_sbml = os.path.join(os.path.dirname(__file__),'..','sbml','b2.xml')
+
+def test_model_cache():
+    '''
+    Test that models are compiled once and handed out as
+    independent instances.
+    '''
+    from sabaody.model_cache import ModelCache, read_sbml
+    c = ModelCache()
+    r1 = c.getModel(b2_sbml)
+    # passing the content instead of the path should hit the same entry
+    r2 = c.getModel(read_sbml(b2_sbml))
+    assert c.misses == 1
+    assert c.hits == 1
+    assert r1 is not r2
+    # instances should not share state
+    r1['cpep'] = 100.
+    assert r2['cpep'] != 100.
+
+def test_model_cache_disk(tmpdir):
+    '''
+    Test that a second process-level cache can load the
+    compiled model from disk.
+    '''
+    from sabaody.model_cache import ModelCache
+    c1 = ModelCache(cache_dir=str(tmpdir))
+    r1 = c1.getModel(b2_sbml)
+    assert len(tmpdir.listdir()) == 1
+    c2 = ModelCache(cache_dir=str(tmpdir))
+    r2 = c2.getModel(b2_sbml)
+    assert r1['cpep'] == r2['cpep']
+    s1 = r1.simulate(0,10,10,['time','cpep'])
+    s2 = r2.simulate(0,10,10,['time','cpep'])
+    assert abs(s1[-1,1] - s2[-1,1]) < 1e-6
+
+def test_bulk_parameter_values():
+    '''
+    Setting parameters in bulk should match setting them one at a time.
+    '''
+    from sabaody.model_cache import get_model, global_parameter_indices, set_parameter_values
+    from sabaody.scripts.b2.params import param_list, getDefaultParamValues
+    r1 = get_model(b2_sbml)
+    r2 = get_model(b2_sbml)
+    x = 1.5*getDefaultParamValues()
+    indices = global_parameter_indices(r1, param_list)
+    assert indices is not None
+    set_parameter_values(r1, param_list, indices, x)
+    set_parameter_values(r2, param_list, None, x)
+    for p in param_list:
+        assert r1[p] == r2[p]
+    # species are not global parameters
+    assert global_parameter_indices(r1, ['cpep']) is None
@@ -0,0 +1,120 @@
+from __future__ import print_function, division, absolute_import
+
+from numpy import array
+from sabaody import Evaluator
+
+class CountingEvaluator(Evaluator):
+    '''
+    Sum of squares, counts the number of evaluations.
+    '''
+    def __init__(self):
+        self.n = 0
+
+    def evaluate(self, x):
+        self.n += 1
+        return float((x**2).sum())
+
+def test_memoized_evaluator():
+    '''
+    Test hits, misses and LRU eviction of the memoized evaluator.
+    '''
+    from sabaody import MemoizedEvaluator
+    e = CountingEvaluator()
+    m = MemoizedEvaluator(e, maxsize=2)
+    assert m.evaluate(array([1.,2.])) == 5.
+    assert m.evaluate(array([1.,2.])) == 5.
+    # round-off should not cause a miss
+    assert m.evaluate(array([1.,2.])*(1.+1e-15)) == 5.
+    assert e.n == 1
+    assert (m.hits,m.misses) == (2,1)
+    m.evaluate(array([3.,4.]))
+    m.evaluate(array([5.,6.]))
+    # [1,2] was least recently used and should be evicted
+    m.evaluate(array([1.,2.]))
+    assert e.n == 4
+    # [5,6] is still cached
+    m.evaluate(array([5.,6.]))
+    assert e.n == 4
+
+def test_surrogate_evaluator():
+    '''
+    After training, only a fraction of each batch should
+    be evaluated exactly.
+    '''
+    from sabaody.surrogate import SurrogateEvaluator
+    from numpy.random import RandomState
+    rs = RandomState(0)
+    e = CountingEvaluator()
+    s = SurrogateEvaluator(e, fraction=0.25, min_samples=20, retrain_interval=10, penalty=1e9)
+    X = rs.uniform(-1., 1., (20,3))
+    # not trained yet - everything is exact
+    assert (s.evaluateBatch(X) == (X**2).sum(axis=1)).all()
+    assert e.n == 20 and s.trained
+    X = rs.uniform(-1., 1., (40,3))
+    f = s.evaluateBatch(X)
+    assert e.n == 30
+    assert s.saved_evaluations == 30
+    # quadratic is easy to fit
+    assert s.isTrusted()
+    assert abs(s.surrogate.predict(X) - (X**2).sum(axis=1)).mean() < 0.2
+    # the exactly evaluated candidates are the best predicted ones
+    exact = [k for k in range(40) if f[k] == (X[k]**2).sum()]
+    assert len(exact) == 10 and (X**2).sum(axis=1).argmin() in exact
+    # the others get the penalty, never their prediction
+    assert all(f[k] == 1e9 for k in range(40) if k not in exact)
+
+def test_memoized_evaluator_penalty():
+    '''
+    Penalty scores (e.g. from timeouts) should not be cached.
+    '''
+    from sabaody import MemoizedEvaluator
+    class FlakyEvaluator(CountingEvaluator):
+        penalty = 1e9
+        def evaluate(self, x):
+            f = super().evaluate(x)
+            return self.penalty if self.n == 1 else f
+    e = FlakyEvaluator()
+    m = MemoizedEvaluator(e)
+    assert m.evaluate(array([1.,2.])) == 1e9
+    assert m.evaluate(array([1.,2.])) == 5.
+    assert m.evaluate(array([1.,2.])) == 5.
+    assert e.n == 2
+
+def test_surrogate_retrains_past_max_samples():
+    '''
+    The surrogate should keep retraining once the training
+    set is capped at max_samples.
+    '''
+    from sabaody.surrogate import SurrogateEvaluator
+    from numpy.random import RandomState
+    rs = RandomState(0)
+    s = SurrogateEvaluator(CountingEvaluator(), min_samples=20, retrain_interval=10, max_samples=50)
+    fit = s.surrogate.fit
+    fits = []
+    s.surrogate.fit = lambda X, f: (fits.append(len(f)), fit(X, f))
+    for k in range(200):
+        s.evaluate(rs.uniform(-1., 1., 3))
+    assert fits == [20, 30, 40] + [50]*16
+
+def test_memoized_batch_evaluation():
+    '''
+    Batches should be looked up in the memo, and only the
+    distinct misses passed on to the batch evaluator.
+    '''
+    from sabaody import MemoizedEvaluator
+    class CountingBatchEvaluator:
+        def __init__(self):
+            self.rows = []
+        def evaluateBatch(self, X):
+            self.rows.append(X.shape[0])
+            return (X**2).sum(axis=1)
+    e = CountingEvaluator()
+    b = CountingBatchEvaluator()
+    m = MemoizedEvaluator(e, batch_evaluator=b)
+    m.evaluate(array([1.,2.]))
+    X = array([[1.,2.],[3.,4.],[3.,4.],[5.,6.]])
+    assert (m.evaluateBatch(X) == (X**2).sum(axis=1)).all()
+    # [1,2] was cached and [3,4] is only evaluated once
+    assert b.rows == [2] and e.n == 1
+    assert (m.evaluateBatch(X) == (X**2).sum(axis=1)).all()
+    assert b.rows == [2]
@@ -0,0 +1,108 @@
+from __future__ import print_function, division, absolute_import
+
+from numpy import array, exp, allclose, log10
+
+def make_decay_model(log_params=False):
+    '''
+    First order decay S1 -> S2 with rate constant k.
+    The data is generated with k=0.5.
+    '''
+    import tellurium as te
+    from sabaody.timecourse_model import TimecourseModel
+    sbml = te.antimonyToSBML('S1 -> S2; k*S1; S1=10; S2=0; k=0.3')
+    t = array([0.5, 1., 1.5, 2., 3.])
+    S1 = array([t, 10.*exp(-0.5*t)]).T
+    S2 = array([t[1::2], 10.-10.*exp(-0.5*t[1::2])]).T
+    return TimecourseModel(sbml, [S1,S2], {'S1': S1, 'S2': S2}, param_list=['k'], log_params=log_params)
+
+def test_gradient():
+    '''
+    Forward sensitivities and forward differences should agree
+    with a finite difference of the MSE.
+    '''
+    m = make_decay_model()
+    x = array([0.3])
+    h = 1e-6
+    expected = (m.evaluate(x+h) - m.evaluate(x))/h
+    assert allclose(m.gradient(x, 'fd'), expected, rtol=1e-3)
+    # the sensitivity path prepares (and pre-equilibrates) only once
+    prepare = m.prepare
+    calls = []
+    m.prepare = lambda p: (calls.append(p), prepare(p))
+    assert allclose(m.gradient(x, 'sensitivity'), expected, rtol=1e-3)
+    assert len(calls) == 1
+    del m.prepare
+    # should vanish at the true value
+    assert abs(m.gradient(array([0.5]))[0]) < 1e-4
+
+def test_gradient_log_params():
+    m = make_decay_model(log_params=True)
+    x = log10(array([0.3]))
+    h = 1e-6
+    expected = (m.evaluate(x+h) - m.evaluate(x))/h
+    assert allclose(m.gradient(x), expected, rtol=1e-3)
+
+def test_experiment_set():
+    '''
+    Two experiments with different initial amounts of S1
+    should share one model and both fit k=0.5.
+    '''
+    import tellurium as te
+    from sabaody.experiment_set import Experiment, ExperimentSet
+    sbml = te.antimonyToSBML('S1 -> S2; k*S1; S1=10; S2=0; k=0.3')
+    t = array([0.5, 1., 1.5, 2., 3.])
+    experiments = []
+    for S1_0 in (10., 4.):
+        S1 = array([t, S1_0*exp(-0.5*t)]).T
+        experiments.append(Experiment([S1], {'S1': S1}, {'S1': S1_0}))
+    s = ExperimentSet(sbml, experiments, param_list=['k'])
+    assert s.models[0].r is s.models[1].r
+    assert s.n_residuals == 2*len(t)
+    assert s.evaluate(array([0.5])) < 1e-8
+    # pooled MSE over both experiments
+    f0 = s.models[0].evaluate(array([0.3]))
+    f1 = s.models[1].evaluate(array([0.3]))
+    assert allclose(s.evaluate(array([0.3])), (f0+f1)/2)
+    t_set = ExperimentSet(sbml, experiments, param_list=['k'], parallel='threads')
+    assert t_set.models[0].r is not t_set.models[1].r
+    assert allclose(t_set.evaluate(array([0.3])), s.evaluate(array([0.3])))
+    t_set.close()
+    # with processes, the parent only needs one instance
+    p_set = ExperimentSet(sbml, experiments, param_list=['k'], parallel='processes', processes=2)
+    assert p_set.models[0].r is p_set.models[1].r
+    try:
+        assert allclose(p_set.evaluate(array([0.3])), s.evaluate(array([0.3])))
+    finally:
+        p_set.close()
+
+def test_preequilibration():
+    '''
+    Production/degradation of S1 is pre-equilibrated to k0/k1,
+    then S1 is perturbed by a bolus.
+    '''
+    import tellurium as te
+    from sabaody.timecourse_model import TimecourseModel
+    sbml = te.antimonyToSBML('J0: -> S1; k0; J1: S1 -> ; k1*S1; S1=0; k0=1; k1=0.5')
+    t = array([0.5, 1., 2., 4.])
+    # steady state is 2, bolus to 5, relaxes back with rate k1
+    S1 = array([t, 2.+3.*exp(-0.5*t)]).T
+    m = TimecourseModel(sbml, [S1], {'S1': S1}, param_list=['k0','k1'], initial_conditions={'S1': 5.}, preequilibrate=True)
+    assert m.evaluate(array([1., 0.5])) < 1e-8
+    assert m.steady_state_cache.cold_solves == 1
+    # nearby vector is warm-started from the cache
+    m.evaluate(array([1.01, 0.5]))
+    assert m.steady_state_cache.warm_starts == 1
+    m.evaluate(array([1., 0.5]))
+    assert m.steady_state_cache.hits == 1
+
+    # experiments on one instance solve the steady state once per parameter vector
+    from sabaody.experiment_set import Experiment, ExperimentSet
+    S1_low = array([t, 2.+1.*exp(-0.5*t)]).T
+    e = ExperimentSet(sbml, [
+        Experiment([S1], {'S1': S1}, {'S1': 5.}),
+        Experiment([S1_low], {'S1': S1_low}, {'S1': 3.}),
+      ], param_list=['k0','k1'], preequilibrate=True)
+    cache = e.models[0].steady_state_cache
+    assert e.models[1].steady_state_cache is cache
+    assert e.evaluate(array([1., 0.5])) < 1e-8
+    assert cache.cold_solves == 1 and cache.hits == 1